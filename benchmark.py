@@ -0,0 +1,227 @@
+import argparse
+import json
+import subprocess
+import time
+import numpy as np
+import tabulate
+import torch
+import models
+import utils
+
+parser = argparse.ArgumentParser(description='WAGE microbenchmarks')
+parser.add_argument('--out', type=str, default=None, metavar='PATH',
+                    help='write the results as JSON (default: None)')
+parser.add_argument('--compare', type=str, default=None, metavar='PATH',
+                    help='JSON results of another commit to compare against')
+parser.add_argument('--sizes', type=int, nargs='+', default=[2**12, 2**16, 2**20, 2**23],
+                    help='number of elements of the quantized tensors')
+parser.add_argument('--bits', type=int, nargs='+', default=[2, 8],
+                    help='bit widths to sweep')
+parser.add_argument('--repeats', type=int, default=20, metavar='N')
+parser.add_argument('--batch_size', type=int, default=128, metavar='N')
+parser.add_argument('--steps', type=int, default=5, metavar='N',
+                    help='number of VGG7LP training steps to time')
+parser.add_argument('--threads', type=int, default=0, metavar='N',
+                    help='number of intra-op CPU threads; 0 keeps the torch default')
+parser.add_argument('--seed', type=int, default=0, metavar='N')
+parser.add_argument('--zeros', type=float, nargs='+', default=[0.5, 0.75, 0.9],
+                    help='fractions of zero ternary weights for the dense/sparse engine cases')
+parser.add_argument('--packed', type=str, default=None, metavar='PATH',
+                    help='also time a packed export (train.py --export-packed) dense and sparse')
+
+def timeit(fn, repeats, warmup=3):
+    for _ in range(warmup): fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000., float(np.min(times)) * 1000.
+
+def counter_sr(x):
+    models.set_sr_rng(models.CounterRNG(0))
+    try:
+        return models.SR_(x)
+    finally:
+        models.set_sr_rng(None)
+
+def predicted_shift(fn, every=4):
+    # steady state of a ShiftPredictor: one QE/QG call per step, measured every `every` steps
+    predictor = models.ShiftPredictor(every=every)
+    def run():
+        predictor.set_step(predictor.step + 1)
+        models.set_shift_predictor(predictor)
+        try:
+            return fn()
+        finally:
+            models.set_shift_predictor(None)
+    return run
+
+def quantizer_cases(n, bits):
+    # QE/QG normalize in place, so their timings include one copy_; see 'copy'
+    src = torch.randn(n)
+    x = src.clone()
+    codes = torch.randint(-2**20, 2**20, (n,))
+    scale = 4.0
+    return [
+        ('copy', lambda: x.copy_(src)),
+        ('C', lambda: models.C(src, bits)),
+        ('Q', lambda: models.Q(src, bits)),
+        ('SR', lambda: models.SR(src)),
+        ('SR_counter', lambda: counter_sr(x.copy_(src))),
+        ('QW', lambda: models.QW(src, bits, scale)),
+        ('QE', lambda: models.QE(x.copy_(src), bits)),
+        ('QG', lambda: models.QG(x.copy_(src), bits, -1, 8.0)),
+        ('QE_predicted', predicted_shift(lambda: models.QE(x.copy_(src), bits))),
+        ('QG_predicted', predicted_shift(lambda: models.QG(x.copy_(src), bits, -1, 8.0))),
+        ('QW_fused', lambda: models.QW_fused(src, bits, scale)),
+        ('QE_fused', lambda: models.QE_fused(x.copy_(src), bits)),
+        ('QG_fused', lambda: models.QG_fused(x.copy_(src), bits, -1, 8.0)),
+        ('QE_int', lambda: models.QE_int(codes, bits)),
+        ('QG_int', lambda: models.QG_int(codes, -1, 3)),
+    ]
+
+def quantizer_module_case(n, bits):
+    quant = models.WAGEQuantizer(bits, bits, "bench")
+    x = torch.randn(n // 1024, 1024, requires_grad=True)
+    grad = torch.randn(n // 1024, 1024)
+    def step():
+        quant(x).backward(grad)
+    return ('WAGEQuantizer', step)
+
+def train_step_case(args, bits):
+    model = models.VGG7LP.base(wl_activate=8, wl_error=8, wl_weight=bits, fl_activate=-1,
+                               fl_error=-1, num_classes=10, **models.VGG7LP.kwargs)
+    batches = [(torch.rand(args.batch_size, 3, 32, 32),
+                torch.randint(0, 10, (args.batch_size,))) for _ in range(args.steps)]
+    weight_quantizer = lambda x, scale, bits: models.QW(x, bits, scale)
+    grad_quantizer = lambda x: models.QG(x, 8, -1, 8.0)
+    grad_clip = lambda x, bits: models.C(x, bits)
+    def epoch():
+        utils.train_epoch(batches, model, utils.SSE, weight_quantizer, grad_quantizer,
+                          None, 0, wage_quantize=True, wage_grad_clip=grad_clip,
+                          device=torch.device('cpu'))
+    return epoch
+
+def predicted_step_case(args, bits):
+    predictor = models.ShiftPredictor()
+    epoch = train_step_case(args, bits)
+    def run():
+        models.set_shift_predictor(predictor)
+        try:
+            epoch()
+        finally:
+            models.set_shift_predictor(None)
+    return run, predictor
+
+def integer_step_case(args, bits):
+    model = models.VGG7LP.base(wl_activate=8, wl_error=8, wl_weight=bits, fl_activate=-1,
+                               fl_error=-1, num_classes=10, **models.VGG7LP.kwargs)
+    engine = models.IntegerWAGE(model, bits, 8)
+    batches = [(torch.rand(args.batch_size, 3, 32, 32),
+                torch.randint(0, 10, (args.batch_size,))) for _ in range(args.steps)]
+    def epoch():
+        for x, y in batches: engine.step(x, y, 8.0)
+    return epoch
+
+def ternary_weights(shape, zeros):
+    w = torch.randint(0, 2, shape, dtype=torch.int8) * 2 - 1
+    return w * (torch.rand(shape) >= zeros).to(torch.int8)
+
+def ternary_engine_cases(args, zeros):
+    # the 8192x1024 classifier of VGG7 and a 128 channel 3x3 conv, w_exp 0 so the
+    # accumulator bound holds for any input codes
+    layers = [('ternary-linear-8192x1024', (1024, 8192), torch.randint(-127, 128, (args.batch_size, 8192), dtype=torch.int8)),
+              ('ternary-conv-128x128x3x3', (128, 128, 3, 3),
+               torch.randint(-127, 128, (args.batch_size, 128, 32, 32), dtype=torch.int8))]
+    cases = []
+    for name, shape, x in layers:
+        op = {'type': 'conv' if len(shape) == 4 else 'linear', 'name': name, 'w_exp': 0,
+              'packed': models.pack_ternary(ternary_weights(shape, zeros)), 'shape': shape}
+        if op['type'] == 'conv': op.update(stride=(1, 1), padding=(1, 1))
+        packed = {'bits_W': 2, 'ops': [op]}
+        for mode, sparse in (('dense', False), ('sparse', True)):
+            engine = models.TernaryEngine(packed, sparse=sparse, min_sparsity=0.)
+            cases.append(('%s-z%d-%s' % (name, round(zeros * 100), mode),
+                          lambda engine=engine, x=x: engine(x)))
+    return cases
+
+def packed_engine_cases(args):
+    packed = torch.load(args.packed, map_location='cpu')
+    # the deployed int path: int8 codes of the [-1, 1] images
+    x = torch.rand(args.batch_size, 3, 32, 32) * 2 - 1
+    codes = (models.Q(models.C(x, 8), 8) * models.S(8)).to(torch.int8)
+    cases = []
+    for mode, sparse in (('dense', False), ('sparse', True)):
+        engine = models.TernaryEngine(packed, sparse=sparse)
+        cases.append(('packed-engine-%s' % mode, lambda engine=engine: engine(codes, 7)))
+    print(tabulate.tabulate(engine.sparsity_rows(), ['layer', 'shape', 'zeros', 'mode'],
+                            tablefmt='simple', floatfmt='6.4f'))
+    return cases
+
+def sparse_speedups(results):
+    """dense/sparse time of every *-sparse row"""
+    dense = {r['name'][:-len('-dense')]: r['median_ms'] for r in results if r['name'].endswith('-dense')}
+    return [[r['name'][:-len('-sparse')], dense[r['name'][:-len('-sparse')]], r['median_ms'],
+             dense[r['name'][:-len('-sparse')]] / r['median_ms']]
+            for r in results if r['name'].endswith('-sparse')]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    if args.threads > 0: torch.set_num_threads(args.threads)
+
+    results = []
+    for bits in args.bits:
+        for n in args.sizes:
+            for name, fn in quantizer_cases(n, bits) + [quantizer_module_case(n, bits)]:
+                median, best = timeit(fn, args.repeats)
+                results.append({'name': name, 'numel': n, 'bits': bits,
+                                'median_ms': median, 'min_ms': best})
+        median, best = timeit(train_step_case(args, bits), max(1, args.repeats // 10), warmup=1)
+        results.append({'name': 'VGG7LP-train-step', 'numel': args.batch_size, 'bits': bits,
+                        'median_ms': median / args.steps, 'min_ms': best / args.steps})
+        step, predictor = predicted_step_case(args, bits)
+        median, best = timeit(step, max(1, args.repeats // 10), warmup=1)
+        results.append({'name': 'VGG7LP-train-step-predicted-shift', 'numel': args.batch_size,
+                        'bits': bits, 'median_ms': median / args.steps, 'min_ms': best / args.steps})
+        print("predicted shifts, {} bits: {}".format(bits, predictor.summary()))
+        median, best = timeit(integer_step_case(args, bits), max(1, args.repeats // 10), warmup=1)
+        results.append({'name': 'VGG7LP-integer-step', 'numel': args.batch_size, 'bits': bits,
+                        'median_ms': median / args.steps, 'min_ms': best / args.steps})
+
+    cases = [case for zeros in args.zeros for case in ternary_engine_cases(args, zeros)]
+    if args.packed is not None: cases += packed_engine_cases(args)
+    with torch.no_grad():
+        for name, fn in cases:
+            median, best = timeit(fn, max(1, args.repeats // 4), warmup=1)
+            results.append({'name': name, 'numel': args.batch_size, 'bits': 2,
+                            'median_ms': median, 'min_ms': best})
+
+    report = {'commit': git_commit(), 'torch': torch.__version__,
+              'threads': torch.get_num_threads(), 'results': results}
+    rows = [[r['name'], r['numel'], r['bits'], r['median_ms'], r['min_ms']] for r in results]
+    columns = ['name', 'numel', 'bits', 'median_ms', 'min_ms']
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = {(r['name'], r['numel'], r['bits']): r['median_ms']
+                   for r in json.load(f)['results']}
+        for row in rows:
+            base = old.get(tuple(row[:3]))
+            row.append(base / row[3] if base else float('nan'))
+        columns.append('speedup')
+    print(tabulate.tabulate(rows, columns, tablefmt='simple', floatfmt='8.4f'))
+    print(tabulate.tabulate(sparse_speedups(results), ['ternary', 'dense_ms', 'sparse_ms', 'speedup'],
+                            tablefmt='simple', floatfmt='8.4f'))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import tabulate
+import torch
+import data
+import models
+import utils
+
+parser = argparse.ArgumentParser(description='Per-layer bit-width search for a trained WAGE model')
+parser.add_argument('--checkpoint', type=str, required=True, metavar='CKPT',
+                    help='checkpoint written by train.py')
+parser.add_argument('--data_path', type=str, default='./data', metavar='PATH')
+parser.add_argument('--model', type=str, default='VGG7LP')
+parser.add_argument('--wl-weight', type=int, default=2, metavar='N',
+                    help='weight bits the checkpoint was trained with')
+parser.add_argument('--wl-activate', type=int, default=8, metavar='N')
+parser.add_argument('--wl-error', type=int, default=8, metavar='N')
+parser.add_argument('--bits-config', type=str, default=None, metavar='PATH',
+                    help='per-layer bits the checkpoint was trained with (default: None)')
+parser.add_argument('--search', type=str, nargs='+', default=['weight', 'activate'],
+                    choices=['weight', 'activate'], help='which bit widths to lower')
+parser.add_argument('--weight-candidates', type=int, nargs='+', default=[6, 4, 3, 2, 1],
+                    help='weight bit widths tried, those below the trained width of each layer; '
+                         '1 is binary (default: 6 4 3 2 1, so a ternary model tries binary)')
+parser.add_argument('--activate-candidates', type=int, nargs='+', default=[6, 4, 3, 2],
+                    help='activation bit widths tried, those below the trained width of each layer '
+                         '(default: 6 4 3 2)')
+parser.add_argument('--budget', type=float, default=0.5, metavar='PERC',
+                    help='allowed drop of test accuracy, in percent (default: 0.5)')
+parser.add_argument('--objective', type=str, default='latency', choices=['latency', 'memory'])
+parser.add_argument('--eval-samples', type=int, default=2000, metavar='N',
+                    help='test images used to measure accuracy (default: 2000)')
+parser.add_argument('--batch_size', type=int, default=200, metavar='N')
+parser.add_argument('--repeats', type=int, default=10, metavar='N',
+                    help='timed forward passes per layer')
+parser.add_argument('--threads', type=int, default=0, metavar='N',
+                    help='number of intra-op CPU threads; 0 keeps the torch default')
+parser.add_argument('--out', type=str, default='bits.json', metavar='PATH',
+                    help='where to write the chosen config, for train.py --bits-config')
+
+weight_quantizer = lambda x, scale, bits: models.QW(x, bits, scale)
+
+def full_bits(bits):
+    return 32 if bits == -1 else bits
+
+class Layers(object):
+    """the bit widths of a built model, read and written by layer name"""
+    def __init__(self, model):
+        self.model = model
+        self.params = models.layer_params(model)
+        self.quantizers = {m.name: m for m in model.modules() if isinstance(m, models.WAGEQuantizer)}
+        self.names = list(self.params)
+
+    def get(self, layer, key):
+        if key == 'weight': return self.model.wl_weight[self.params[layer]]
+        return self.quantizers[layer].bits_A
+
+    def set(self, layer, key, bits):
+        if key == 'weight':
+            self.model.wl_weight[self.params[layer]] = bits
+            self.model.invalidate_weights()
+        else:
+            self.quantizers[layer].bits_A = bits
+
+    def searchable(self, layer, key):
+        # bf-loss only quantizes the backward pass
+        return key == 'weight' or self.quantizers[layer].bits_A != -1
+
+    def config(self):
+        bits = {}
+        for layer in self.names:
+            bits[layer] = {'weight': self.get(layer, 'weight')}
+            if self.searchable(layer, 'activate'): bits[layer]['activate'] = self.get(layer, 'activate')
+        return bits
+
+def candidates(args, key, trained):
+    """the candidate widths of key below the trained one, narrowest last"""
+    return sorted({b for b in getattr(args, key + '_candidates') if b < full_bits(trained)},
+                  reverse=True)
+
+def profile(model, layers, x, repeats):
+    """fp32 CPU latency (ms) and output size per sample of every conv/linear"""
+    modules = dict(model.named_modules())
+    stats, hooks = {}, []
+    for layer, param in layers.params.items():
+        module = modules[param.rsplit('.', 1)[0]]
+        stats[layer] = {'weight_numel': module.weight.numel(), 'times': []}
+        def pre(module, inputs, layer=layer):
+            stats[layer]['start'] = time.perf_counter()
+        def post(module, inputs, output, layer=layer):
+            stats[layer]['times'].append(time.perf_counter() - stats[layer]['start'])
+            stats[layer]['act_numel'] = output[0].numel()
+        hooks += [module.register_forward_pre_hook(pre), module.register_forward_hook(post)]
+    with torch.no_grad():
+        for _ in range(repeats + 1): model(x)
+    for h in hooks: h.remove()
+    return {layer: {'latency_ms': float(np.median(s['times'][1:])) * 1000.,
+                    'weight_numel': s['weight_numel'], 'act_numel': s['act_numel']}
+            for layer, s in stats.items()}
+
+def cost(layers, stats, objective):
+    """
+    latency: the measured fp32 latency scaled by the bit-ops of the layer,
+    (weight bits x input activation bits) / (32 x 32); the float emulation
+    itself does not get faster with fewer bits.
+    memory: bytes of the weights plus the output activation of one sample.
+    """
+    total, in_bits = 0., 8 # images are 8-bit
+    for layer in layers.names:
+        w = full_bits(layers.get(layer, 'weight'))
+        a = full_bits(layers.get(layer, 'activate'))
+        s = stats[layer]
+        if objective == 'latency':
+            total += s['latency_ms'] * w * in_bits / (32. * 32.)
+        else:
+            total += (s['weight_numel'] * w + s['act_numel'] * a) / 8.
+        in_bits = a
+    return total
+
+def accuracy(loader, model):
+    return utils.eval(loader, model, utils.SSE, weight_quantizer)['accuracy']
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    if args.threads > 0: torch.set_num_threads(args.threads)
+
+    bits = models.load_bits(args.bits_config) if args.bits_config is not None else None
+    model_cfg = getattr(models, args.model)
+    model = model_cfg.base(*model_cfg.args, num_classes=10, wl_weight=args.wl_weight,
+                           wl_activate=args.wl_activate, wl_error=args.wl_error, bits=bits,
+                           **model_cfg.kwargs)
+    utils.load_weights(model, torch.load(args.checkpoint, map_location='cpu',
+                                          weights_only=False))
+    layers = Layers(model)
+
+    images, labels = data.cifar_arrays(os.path.join(args.data_path, 'cifar10'), False)
+    images, labels = images[:args.eval_samples], labels[:args.eval_samples]
+    loader = data.TensorLoader(images, labels, args.batch_size, 'cpu')
+
+    model.project_weights(weight_quantizer)
+    x = next(iter(loader))[0][:1]*2-1
+    stats = profile(model, layers, x, args.repeats)
+    base_acc = accuracy(loader, model)
+    base_cost = cost(layers, stats, args.objective)
+    print("trained config: acc {:.2f}, {} {:.4f}".format(base_acc, args.objective, base_cost))
+
+    # sensitivity: lower one layer at a time
+    moves = []
+    for layer in layers.names:
+        for key in args.search:
+            if not layers.searchable(layer, key): continue
+            trained = layers.get(layer, key)
+            for b in candidates(args, key, trained):
+                layers.set(layer, key, b)
+                drop = base_acc - accuracy(loader, model)
+                saving = base_cost - cost(layers, stats, args.objective)
+                layers.set(layer, key, trained)
+                moves.append({'layer': layer, 'key': key, 'bits': b,
+                              'drop': drop, 'saving': saving})
+                print("{:>16} {:>8} {:2d} bits: drop {:6.2f}, saving {:.4f}".format(
+                    layer, key, b, drop, saving))
+
+    # greedy: cheapest saving per accuracy point first, each step checked on the
+    # combined config since the drops of different layers do not simply add up
+    moves.sort(key=lambda m: m['saving'] / max(m['drop'], 1e-2), reverse=True)
+    acc = base_acc
+    for m in moves:
+        current = layers.get(m['layer'], m['key'])
+        if m['bits'] >= full_bits(current) or m['saving'] <= 0: continue
+        layers.set(m['layer'], m['key'], m['bits'])
+        new_acc = accuracy(loader, model)
+        if base_acc - new_acc <= args.budget:
+            acc = new_acc
+        else:
+            layers.set(m['layer'], m['key'], current)
+
+    config = layers.config()
+    rows = [[layer, config[layer]['weight'], config[layer].get('activate', '-'),
+             stats[layer]['latency_ms'], stats[layer]['weight_numel'], stats[layer]['act_numel']]
+            for layer in layers.names]
+    print(tabulate.tabulate(rows, ['layer', 'weight', 'activate', 'fp32_ms', 'weights', 'acts'],
+                            tablefmt='simple', floatfmt='8.4f'))
+    print("chosen config: acc {:.2f} (drop {:.2f}), {} {:.4f} ({:.1f}% of trained)".format(
+        acc, base_acc - acc, args.objective, cost(layers, stats, args.objective),
+        cost(layers, stats, args.objective) / base_cost * 100.))
+    models.save_bits(config, args.out)
+    with open(os.path.splitext(args.out)[0] + '-report.json', 'w') as f:
+        json.dump({'base_acc': base_acc, 'acc': acc, 'objective': args.objective,
+                   'base_cost': base_cost, 'cost': cost(layers, stats, args.objective),
+                   'layers': stats, 'moves': moves, 'bits': config}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
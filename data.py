@@ -0,0 +1,179 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.datasets as datasets
+
+def quantize_images(images, bits):
+    """uint8 images -> int8 codes of Q(C(2x-1)) on the 1/S(bits) grid, as the network sees them"""
+    S = 2.**(bits-1)
+    x = images.astype(np.float32) / 255. * 2 - 1
+    return np.round(np.clip(x, -1 + 1/S, 1 - 1/S) * S).astype(np.int8)
+
+def cache_dir(path, train, bits=-1):
+    split = 'train' if train else 'test'
+    return os.path.join(path, 'cifar10-%s' % split + ('' if bits == -1 else '-a%d' % bits))
+
+def write_cache(src, dst, bits=-1):
+    """
+    decode both splits from src once and store them under dst as raw
+    contiguous NHWC images (uint8, or int8 codes when pre-quantized to
+    `bits`), uint8 labels, and a meta.json describing them
+    """
+    for train in [True, False]:
+        out = cache_dir(dst, train, bits)
+        if os.path.exists(os.path.join(out, 'meta.json')): continue
+        ds = datasets.CIFAR10(src, train=train, download=True)
+        images = ds.data if bits == -1 else quantize_images(ds.data, bits)
+        labels = np.asarray(ds.targets, dtype=np.uint8)
+        # written aside and renamed, so concurrent runs never see a partial cache
+        tmp = '%s.tmp%d' % (out, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        np.ascontiguousarray(images).tofile(os.path.join(tmp, 'images.bin'))
+        labels.tofile(os.path.join(tmp, 'labels.bin'))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'count': len(labels), 'shape': list(images.shape[1:]),
+                       'dtype': str(images.dtype), 'bits': bits,
+                       'classes': len(ds.classes)}, f)
+        try:
+            os.rename(tmp, out)
+        except OSError:
+            shutil.rmtree(tmp) # another run finished first
+
+def load_cache(path, train, bits=-1):
+    """memory-mapped images and labels of a cache written by write_cache, and its meta"""
+    out = cache_dir(path, train, bits)
+    with open(os.path.join(out, 'meta.json')) as f:
+        meta = json.load(f)
+    images = np.memmap(os.path.join(out, 'images.bin'), dtype=meta['dtype'], mode='r',
+                       shape=(meta['count'],) + tuple(meta['shape']))
+    labels = np.fromfile(os.path.join(out, 'labels.bin'), dtype=np.uint8)
+    return images, labels, meta
+
+def cifar_arrays(path, train, mmap=False, bits=-1):
+    """
+    NHWC images and int64 labels of a CIFAR10 split: uint8, or int8 codes
+    on the 1/S(bits) grid. With mmap, from the cache under path (written on
+    first use), otherwise decoded into memory.
+    """
+    if mmap:
+        write_cache(path, path, bits)
+        images, labels, _ = load_cache(path, train, bits)
+        return images, labels.astype(np.int64)
+    ds = datasets.CIFAR10(path, train=train, download=True)
+    images = ds.data if bits == -1 else quantize_images(ds.data, bits)
+    return images, np.asarray(ds.targets, dtype=np.int64)
+
+def augment(x, generator, padding=4, value=0):
+    """random crop with constant padding and horizontal flip of a NHWC batch"""
+    B, H, W, _ = x.shape
+    x = F.pad(x, (0, 0, padding, padding, padding, padding), value=value)
+    offset_y = torch.randint(0, 2*padding+1, (B, 1), generator=generator).to(x.device)
+    offset_x = torch.randint(0, 2*padding+1, (B, 1), generator=generator).to(x.device)
+    flip = torch.randint(0, 2, (B, 1), generator=generator).bool().to(x.device)
+    rows = offset_y + torch.arange(H, device=x.device)
+    cols = torch.arange(W, device=x.device)
+    cols = offset_x + torch.where(flip, W-1-cols, cols)
+    batch = torch.arange(B, device=x.device)
+    return x[batch[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+class TensorLoader(object):
+    """
+    Iterates over an in-memory (or memory-mapped) uint8 array and does the
+    augmentation as batched tensor ops on the target device, with the next
+    batches prepared by a background thread. Yields [0-1] NCHW float batches,
+    like ToTensor. With bits, images are int8 codes from quantize_images and
+    the batches are exactly (code/S + 1)/2, i.e. on the grid after x*2-1.
+    """
+    def __init__(self, images, labels, batch_size, device, train=False, prefetch=2,
+                 rank=0, world_size=1, seed=None, bits=-1):
+        self.images = images
+        self.bits = bits
+        self.labels = torch.from_numpy(np.asarray(labels, dtype=np.int64))
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.train = train
+        self.prefetch = prefetch
+        # shards need a shuffling seed shared by all ranks, like DistributedSampler
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        n = (len(self.labels) + self.world_size - 1) // self.world_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def _batches(self, seed):
+        generator = torch.Generator().manual_seed(seed)
+        n = len(self.labels)
+        if self.train and self.seed is not None:
+            shuffle = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=shuffle)
+        elif self.train:
+            order = torch.randperm(n, generator=generator)
+        else:
+            order = torch.arange(n)
+        if self.world_size > 1:
+            # wrap around to equal shards, like DistributedSampler: every rank must
+            # run the same number of steps, or the extra all-reduce hangs
+            total = (n + self.world_size - 1) // self.world_size * self.world_size
+            order = torch.cat([order, order[:total - n]])
+        order = order[self.rank::self.world_size]
+        n = len(order)
+        pin = self.device.type == 'cuda'
+        for start in range(0, n, self.batch_size):
+            # sorted reads are friendlier to memory-mapped arrays
+            idx = order[start:start+self.batch_size].sort()[0]
+            x = torch.from_numpy(np.ascontiguousarray(self.images[idx.numpy()]))
+            y = self.labels[idx]
+            if pin: x, y = x.pin_memory(), y.pin_memory()
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
+            if self.bits == -1:
+                if self.train: x = augment(x, generator)
+                yield x.permute(0, 3, 1, 2).float().div_(255), y
+                continue
+            S = 2.**(self.bits-1)
+            # pad with the code of C(-1), where a black uint8 pixel would end up
+            if self.train: x = augment(x, generator, value=-(S-1))
+            yield x.permute(0, 3, 1, 2).float().div_(S).add_(1).div_(2), y
+
+    def __iter__(self):
+        # drawn from the global RNG, so the shuffling follows torch.manual_seed;
+        # test loaders draw nothing, so evaluating does not shift the training stream
+        seed = int(torch.empty((), dtype=torch.int64).random_().item()) if self.train else 0
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        def produce():
+            try:
+                for batch in self._batches(seed):
+                    if not put(batch): return
+                put(None)
+            except Exception as e:
+                put(e)
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None: return
+                if isinstance(batch, Exception): raise batch
+                yield batch
+        finally:
+            # also ends the producer when the consumer stops early
+            stop.set()
@@ -0,0 +1,58 @@
+import torch
+import torch.distributed as dist
+import models
+
+def init(backend='gloo'):
+    """join the process group described by the torchrun environment"""
+    dist.init_process_group(backend, init_method='env://')
+    return dist.get_rank(), dist.get_world_size()
+
+def broadcast_state(model, src=0):
+    """start every replica from the accumulators of rank `src`"""
+    for name, acc in model.weight_acc.items():
+        buf = acc.detach().cpu()
+        dist.broadcast(buf, src)
+        model.weight_acc[name] = acc.copy_(buf)
+    model.invalidate_weights()
+
+def gather_rng(state):
+    """the rng_state() of every rank, on every rank"""
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, state)
+    return states
+
+class QuantizedGradExchange(object):
+    """
+    Data-parallel WAGE update. The ranks first agree on the largest max|grad|
+    (one scalar all-reduce), so every rank quantizes with QG_codes on the same
+    shift and the codes can be summed directly. The codes are all-gathered as
+    they are, int8 (int16 for lr >= 64), a quarter of the fp32 gradient, and
+    every rank sums them locally in int32. The sum is averaged with a
+    stochastic rounding whose random stream is seeded identically on every
+    rank, so all replicas apply the same update and their weight_acc stay
+    identical. gloo only gathers CPU tensors, so with CUDA gradients the codes
+    go through the host; nccl exchanges them on the device.
+    """
+    def __init__(self, seed, device='cpu'):
+        self.world_size = dist.get_world_size()
+        self.device = torch.device('cpu') if dist.get_backend() == 'gloo' else torch.device(device)
+        self.generator = torch.Generator(device=self.device).manual_seed(seed)
+
+    def __call__(self, grad, bits_G, bits_R, lr):
+        """the averaged QG codes of grad, see models.QG_codes"""
+        max_entry = grad.abs().max().reshape(1).to(self.device)
+        dist.all_reduce(max_entry, op=dist.ReduceOp.MAX)
+        codes = models.QG_codes(grad, bits_G, bits_R, lr, models.shift(max_entry[0]).to(grad.device))
+        sent = codes.to(self.device)
+        gathered = [torch.empty_like(sent) for _ in range(self.world_size)]
+        dist.all_gather(gathered, sent)
+        total = torch.stack(gathered).sum(0, dtype=torch.int32)
+        r = torch.rand(total.shape, generator=self.generator, device=self.device)
+        mean = torch.floor(total.float() / self.world_size + r)
+        return mean.to(codes.device, codes.dtype)
+
+    def state_dict(self):
+        return {'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'])
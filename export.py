@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import numpy as np
+import tabulate
+import torch
+import data
+import models
+import utils
+
+parser = argparse.ArgumentParser(description='WAGE export to TorchScript/ONNX')
+parser.add_argument('--packed', type=str, default=None, metavar='PATH',
+                    help='packed model exported by train.py --export-packed')
+parser.add_argument('--checkpoint', type=str, default=None, metavar='PATH',
+                    help='train.py checkpoint, with --model and the bit widths it was trained with')
+parser.add_argument('--model', type=str, default='VGG7LP', metavar='MODEL')
+parser.add_argument('--wl-weight', type=int, default=2, metavar='N')
+parser.add_argument('--wl-activate', type=int, default=8, metavar='N')
+parser.add_argument('--wl-error', type=int, default=8, metavar='N')
+parser.add_argument('--bits-config', type=str, default=None, metavar='PATH',
+                    help='per-layer bit widths the checkpoint was trained with')
+parser.add_argument('--out', type=str, required=True, metavar='PREFIX',
+                    help='writes PREFIX.pt (TorchScript) and/or PREFIX.onnx')
+parser.add_argument('--format', type=str, default='both', choices=['torchscript', 'onnx', 'both'])
+parser.add_argument('--opset', type=int, default=13, metavar='N')
+parser.add_argument('--verify', action='store_true', default=False,
+                    help='compare the exports (onnxruntime on CPU) with the WAGE model on the '
+                         'CIFAR10 test set')
+parser.add_argument('--atol', type=float, default=1e-4, metavar='F',
+                    help='largest output difference --verify accepts (default: 1e-4)')
+parser.add_argument('--max-acc-delta', type=float, default=0.1, metavar='F',
+                    help='largest test accuracy difference, in %%, --verify accepts (default: 0.1)')
+parser.add_argument('--data_path', type=str, default='./data', metavar='PATH')
+parser.add_argument('--batch_size', type=int, default=256, metavar='N')
+
+def load_model(args):
+    model_cfg = getattr(models, args.model)
+    bits = models.load_bits(args.bits_config) if args.bits_config is not None else None
+    model = model_cfg.base(*model_cfg.args, num_classes=10, wl_weight=args.wl_weight,
+                           wl_activate=args.wl_activate, fl_activate=-1,
+                           wl_error=args.wl_error, fl_error=-1, bits=bits, **model_cfg.kwargs)
+    # checkpoints hold numpy/python RNG states, which weights_only rejects
+    utils.load_weights(model, torch.load(args.checkpoint, map_location='cpu', weights_only=False))
+    return model
+
+def onnx_eval(session, loader):
+    """accuracy of an onnxruntime session and its outputs on the first batch"""
+    correct, cnt, first = 0, 0, None
+    for input_v, target in loader:
+        output = session.run(None, {'image': (input_v*2-1).numpy()})[0]
+        if first is None: first = output
+        correct += int((output.argmax(1) == target.numpy()).sum())
+        cnt += len(target)
+    return correct / float(cnt) * 100.0, first
+
+def verify(args, net, model, paths):
+    loader = data.TensorLoader(*data.cifar_arrays(os.path.join(args.data_path, 'cifar10'), False),
+                               args.batch_size, 'cpu')
+    x = next(iter(loader))[0]*2-1
+    with torch.no_grad(): reference = net(x)
+    rows = [['exported net', utils.eval(loader, net, utils.SSE)['accuracy'], 0.]]
+    if model is not None:
+        weight_quantizer = lambda acc, scale, bits: models.QW(acc, bits, scale)
+        res = utils.eval(loader, model, utils.SSE, weight_quantizer)
+        with torch.no_grad(): diff = (model(x) - reference).abs().max().item()
+        rows.append(['WAGE float path', res['accuracy'], diff])
+    if 'torchscript' in paths:
+        scripted = torch.jit.load(paths['torchscript'])
+        res = utils.eval(loader, scripted, utils.SSE, device=torch.device('cpu'))
+        with torch.no_grad(): diff = (scripted(x) - reference).abs().max().item()
+        rows.append(['TorchScript', res['accuracy'], diff])
+    if 'onnx' in paths:
+        accuracy, output = onnx_eval(models.onnx_session(paths['onnx']), loader)
+        rows.append(['onnxruntime CPU', accuracy, float(np.abs(output - reference.numpy()).max())])
+    print(tabulate.tabulate(rows, ['', 'te_acc', 'max_abs_diff'], tablefmt='simple', floatfmt='8.4f'))
+    # every path computes the same integer sums, up to the fp32 order of summation
+    mismatch = [row[0] for row in rows[1:]
+                if abs(row[1] - rows[0][1]) > args.max_acc_delta or row[2] > args.atol]
+    if mismatch: raise SystemExit("mismatch: {}".format(", ".join(mismatch)))
+
+def main():
+    args = parser.parse_args()
+    assert (args.packed is None) != (args.checkpoint is None), "give --packed or --checkpoint"
+    model = None
+    if args.packed is not None:
+        source = torch.load(args.packed, map_location='cpu')
+    else:
+        source = model = load_model(args)
+    net, metadata = models.inference_net(source)
+    print(json.dumps(metadata, indent=2))
+
+    paths = {}
+    if args.format in ('torchscript', 'both'):
+        paths['torchscript'] = args.out + '.pt'
+        models.export_torchscript(net, metadata, paths['torchscript'])
+    if args.format in ('onnx', 'both'):
+        paths['onnx'] = args.out + '.onnx'
+        models.export_onnx(net, metadata, paths['onnx'], opset=args.opset)
+    print("Wrote {}".format(", ".join(paths.values())))
+    if args.verify: verify(args, net, model, paths)
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,15 @@
 from .wage_quantizer import *
+from .wage_rng import *
+from .wage_shift import *
+from .wage_memory import *
+from .wage_builder import *
 from .vgg_low import *
+from .wage_bits import *
+from .wage_fused import *
+from .wage_flat import *
+from .wage_packed import *
+from .wage_export import *
+from .wage_codes import *
+from .wage_integer import *
+from .wage_telemetry import *
+from .wage_profiler import *
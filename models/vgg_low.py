@@ -4,72 +4,52 @@
 """
 import torch
 import torch.nn as nn
-from .wage_quantizer import WAGEQuantizer, Q
-from .wage_initializer import wage_init_
+from .wage_builder import WAGENet, vgg_features, quantizers, no_batch_norm
 import math
 
-__all__ = ['VGG7LP']
+__all__ = ['VGG7LP', 'VGG11LP', 'VGG16LP']
 
-class VGG(nn.Module):
+# conv widths per depth, 'M' max-pools the conv before it; the two linear
+# layers of the classifier count towards the depth
+cfg = {
+    7: [128, 128, 'M', 256, 256, 'M', 512, 512, 'M'],
+    11: [64, 'M', 128, 'M', 256, 256, 'M', 512, 512, 'M', 512, 512, 'M'],
+    13: [64, 64, 'M', 128, 128, 'M', 256, 256, 'M', 512, 512, 'M', 512, 512, 'M'],
+    16: [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M', 512, 512, 512, 'M', 512, 512, 512, 'M'],
+}
+
+class VGG(WAGENet):
     def __init__(self, wl_activate=-1, fl_activate=-1, wl_error=-1, fl_error=-1,
-                 num_classes=10, depth=16, batch_norm=False, wl_weight=-1, writer=None):
+                 num_classes=10, depth=16, batch_norm=False, wl_weight=-1, writer=None,
+                 fused=False, telemetry=None, bits=None, hidden=1024, image_size=32):
         super(VGG, self).__init__()
-        quant = lambda name : WAGEQuantizer(wl_activate, wl_error, name, writer=writer)
-        self.features = nn.Sequential(*[
-            # Turns out that the input quantization is never used in the original repo
-            # Image input should already been quantized to 8-bits - no need do it again
-            # WAGEQuantizer(wl_activate, -1, "input"), # only quantizing forward
-
-            # Group 1
-            nn.Conv2d(3, 128, kernel_size=3, padding=1, bias=False),
-            nn.ReLU(inplace=True),
-            quant("feature-1-1"),
-
-            nn.Conv2d(128, 128, kernel_size=3, padding=1, bias=False),
-            nn.MaxPool2d(kernel_size=2, stride=2),
-            nn.ReLU(inplace=True),
-            quant("feature-1-2"),
-
-            # Group 2
-            nn.Conv2d(128, 256, kernel_size=3, padding=1, bias=False),
-            nn.ReLU(inplace=True),
-            quant("feature-2-1"),
-
-            nn.Conv2d(256, 256, kernel_size=3, padding=1, bias=False),
-            nn.MaxPool2d(kernel_size=2, stride=2),
-            nn.ReLU(inplace=True),
-            quant("feature-2-2"),
-
-            # Group 3
-            nn.Conv2d(256, 512, kernel_size=3, padding=1, bias=False),
-            nn.ReLU(inplace=True),
-            quant("feature-3-1"),
-
-            nn.Conv2d(512, 512, kernel_size=3, padding=1, bias=False),
-            nn.MaxPool2d(kernel_size=2, stride=2),
-            nn.ReLU(inplace=True),
-            quant("feature-3-2")
-        ])
+        no_batch_norm(batch_norm)
+        if depth not in cfg:
+            raise ValueError("depth {} not in {}".format(depth, sorted(cfg)))
+        # bits: optional per-layer overrides of wl_weight/wl_activate/wl_error, see load_bits
+        quant, loss_quant = quantizers(wl_activate, wl_error, bits, writer, fused, telemetry)
+        # Turns out that the input quantization is never used in the original repo
+        # Image input should already been quantized to 8-bits - no need do it again
+        # WAGEQuantizer(wl_activate, -1, "input"), # only quantizing forward
+        features, channels, self.groups = vgg_features(cfg[depth], quant)
+        self.features = nn.Sequential(*features)
 
+        side = image_size // 2**cfg[depth].count('M')
         self.classifier = nn.Sequential(
-            nn.Linear(8192, 1024, bias=False),
+            nn.Linear(channels * side * side, hidden, bias=False),
             nn.ReLU(inplace=True),
             quant("classifier-lin"),
-            nn.Linear(1024, num_classes, bias=False),
-            WAGEQuantizer(-1, wl_error, "bf-loss") # only quantizing backward pass
+            nn.Linear(hidden, num_classes, bias=False),
+            loss_quant()
         )
-
-        self.weight_scale = {}
-        self.weight_acc = {}
-        for name, param in self.named_parameters():
-            assert 'weight' in name
-            wage_init_(param, wl_weight, name, self.weight_scale, factor=1.0)
-            self.weight_acc[name] = Q(param.data, wl_weight)
+        self.init_wage(wl_weight, bits)
 
     def forward(self, x):
-        x = self.features(x)
-        x = x.view(x.size(0), -1)
-        x = self.classifier(x)
+        with self.saved_codes():
+            for start, end in self.groups:
+                x = self.run_group(self.features[start:end], x)
+            x = torch.flatten(x, 1)
+            x = self.classifier(x)
         return x
 
 class Base:
@@ -80,3 +60,8 @@ class Base:
 class VGG7LP(Base):
     kwargs = {'depth':7}
 
+class VGG11LP(Base):
+    kwargs = {'depth':11}
+
+class VGG16LP(Base):
+    kwargs = {'depth':16}
@@ -0,0 +1,51 @@
+import json
+from collections import OrderedDict
+from .wage_quantizer import WAGEQuantizer
+
+__all__ = ['load_bits', 'save_bits', 'layer_params', 'layer_bits']
+
+# keys of a per-layer entry and the VGG argument they override
+BIT_KEYS = {'weight': 'wl_weight', 'activate': 'wl_activate', 'error': 'wl_error'}
+
+def load_bits(path):
+    """
+    per-layer bit widths, keyed by quantizer name, e.g.
+        {"feature-1-1": {"weight": 8, "activate": 8}, "bf-loss": {"weight": 8}}
+    from a .json or (with pyyaml installed) a .yaml file
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            bits = yaml.safe_load(f)
+        else:
+            bits = json.load(f)
+    for layer, entry in bits.items():
+        unknown = set(entry) - set(BIT_KEYS)
+        if unknown:
+            raise ValueError("{}: unknown keys {}, expected {}".format(
+                layer, sorted(unknown), sorted(BIT_KEYS)))
+    return bits
+
+def save_bits(bits, path):
+    with open(path, 'w') as f:
+        json.dump(bits, f, indent=2)
+
+def layer_params(model):
+    """
+    layer name -> name of the weight it quantizes. A layer is named after the
+    WAGEQuantizer that follows its conv/linear, e.g. feature-1-1 ->
+    features.0.weight, and bf-loss for the last linear.
+    """
+    layers, pending = OrderedDict(), []
+    for module_name, module in model.named_modules():
+        if isinstance(module, WAGEQuantizer):
+            if len(pending) > 0: layers[module.name] = pending.pop()
+            assert len(pending) == 0, "two weights before quantizer %s" % module.name
+        elif getattr(module, 'weight', None) is not None:
+            pending.append(module_name + '.weight' if module_name else 'weight')
+    return layers
+
+def layer_bits(bits, layer, key, default):
+    """bit width of one layer, default when the config leaves it out"""
+    if bits is None: return default
+    return bits.get(layer, {}).get(key, default)
@@ -0,0 +1,234 @@
+"""
+    Config-driven WAGE models: VGG feature stacks, ResNet basic blocks and MLPs
+    with a WAGEQuantizer after every conv/linear and wage_init_ initialization
+"""
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from .wage_quantizer import WAGEQuantizer, Q
+from .wage_memory import saved_codes, recomputed
+from .wage_initializer import wage_init_
+from .wage_bits import layer_params, layer_bits
+
+__all__ = ['WAGENet', 'vgg_features', 'ResNet', 'MLP',
+           'ResNet8LP', 'ResNet20LP', 'MLP3LP']
+
+def quantizers(wl_activate, wl_error, bits=None, writer=None, fused=False, telemetry=None):
+    """quant(name) for the hidden layers and loss_quant() for the one before the loss"""
+    def quant(name):
+        return WAGEQuantizer(layer_bits(bits, name, 'activate', wl_activate),
+                             layer_bits(bits, name, 'error', wl_error),
+                             name, writer=writer, fused=fused, telemetry=telemetry)
+    def loss_quant(name="bf-loss"):
+        # only quantizing backward pass
+        return WAGEQuantizer(-1, layer_bits(bits, name, 'error', wl_error), name,
+                             fused=fused, telemetry=telemetry)
+    return quant, loss_quant
+
+def no_batch_norm(batch_norm):
+    if batch_norm: raise NotImplementedError("WAGE has no batch norm")
+
+class WAGENet(nn.Module):
+    """
+    Keeps the WAGE state of a model: weight_acc in gradient precision, the
+    per layer weight_scale, and the projection of weight_acc into param.data.
+    Subclasses build their modules, then call init_wage.
+    """
+    def init_wage(self, wl_weight, bits=None):
+        layers = layer_params(self)
+        unknown = set(bits or {}) - set(layers)
+        if unknown:
+            raise ValueError("unknown layers {}, expected {}".format(sorted(unknown), list(layers)))
+        self.wl_weight = {param: layer_bits(bits, layer, 'weight', wl_weight)
+                          for layer, param in layers.items()}
+
+        self.weight_scale = {}
+        self.weight_acc = {}
+        for name, param in self.named_parameters():
+            assert 'weight' in name
+            wage_init_(param, self.wl_weight[name], name, self.weight_scale, factor=1.0)
+            self.weight_acc[name] = Q(param.data, self.wl_weight[name])
+        self.wage_flat = None
+        # param.data holds the projection of weight_acc at version projected[name]
+        self.acc_version = {name: 0 for name in self.weight_acc}
+        self.projected = {}
+        self.set_low_memory(False, False)
+
+    def set_low_memory(self, int8_saves=True, checkpoint_groups=False):
+        """
+        int8_saves: autograd keeps the quantized conv/linear inputs as int8 codes
+        checkpoint_groups: recompute each group of layers in backward instead
+        of keeping its activations
+        """
+        self.int8_saves = int8_saves
+        self.checkpoint_groups = checkpoint_groups
+
+    def saved_codes(self):
+        return saved_codes(self.int8_saves)
+
+    def run_group(self, group, x):
+        if self.checkpoint_groups and self.training and torch.is_grad_enabled():
+            return checkpoint(recomputed(group), x, use_reentrant=False)
+        return group(x)
+
+    def mark_updated(self, name):
+        self.acc_version[name] += 1
+
+    def invalidate_weights(self):
+        """call after writing weight_acc outside of the training loop"""
+        self.projected = {}
+        if self.wage_flat is not None: self.wage_flat.invalidate()
+
+    def project_layer(self, name, param, weight_quantizer):
+        """param.data = QW(weight_acc[name])"""
+        if hasattr(self.weight_acc, 'project'):
+            param.data = self.weight_acc.project(name, self.weight_scale[name])
+        else:
+            param.data = weight_quantizer(self.weight_acc[name], self.weight_scale[name],
+                                          self.wl_weight[name])
+        self.projected[name] = self.acc_version[name]
+
+    def project_weights(self, weight_quantizer):
+        """
+        param.data = QW(weight_acc), only for the layers updated since their last
+        projection. Training projects each layer right after its update (see
+        utils.train_epoch), so this only does work after a resume, a broadcast
+        or for frozen/unseen layers, and eval reuses the training projection.
+        """
+        if self.wage_flat is not None: return self.wage_flat.project()
+        for name, param in self.named_parameters():
+            if self.projected.get(name) == self.acc_version[name]: continue
+            self.project_layer(name, param, weight_quantizer)
+
+    def _apply(self, fn, *args, **kwargs):
+        # keep the accumulators on the same device/layout as the parameters
+        super(WAGENet, self)._apply(fn, *args, **kwargs)
+        if hasattr(self.weight_acc, '_apply'):
+            self.weight_acc._apply(fn)
+        else:
+            for name, acc in self.weight_acc.items():
+                self.weight_acc[name] = fn(acc)
+        return self
+
+def vgg_features(cfg, quant, in_channels=3):
+    """
+    cfg lists the conv widths, 'M' max-pools the conv before it, e.g.
+    [128, 128, 'M', 256]. Convs are numbered feature-<group>-<i>, a pool ends
+    a group. Returns the modules, the output channels and the (start, end)
+    indices of the groups.
+    """
+    layers, group, i, ends = [], 1, 0, []
+    for k, v in enumerate(cfg):
+        if v == 'M': continue
+        i += 1
+        layers.append(nn.Conv2d(in_channels, v, kernel_size=3, padding=1, bias=False))
+        pool = k + 1 < len(cfg) and cfg[k + 1] == 'M'
+        if pool: layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        layers += [nn.ReLU(inplace=True), quant("feature-%d-%d" % (group, i))]
+        if pool:
+            group, i = group + 1, 0
+            ends.append(len(layers))
+        in_channels = v
+    if len(ends) == 0 or ends[-1] != len(layers): ends.append(len(layers))
+    return layers, in_channels, list(zip([0] + ends[:-1], ends))
+
+class BasicBlock(nn.Module):
+    """
+    Two 3x3 convs and a shortcut, each output on the activation grid. The
+    modules are registered in execution order, so every weight is followed
+    by its quantizer (see layer_params).
+    """
+    def __init__(self, in_planes, planes, stride, quant, name):
+        super(BasicBlock, self).__init__()
+        self.conv1 = nn.Conv2d(in_planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.quant1 = quant(name + "-1")
+        self.shortcut = None
+        if stride != 1 or in_planes != planes:
+            self.shortcut = nn.Conv2d(in_planes, planes, kernel_size=1, stride=stride, bias=False)
+            self.quant_sc = quant(name + "-sc")
+        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, padding=1, bias=False)
+        self.quant2 = quant(name + "-2")
+
+    def forward(self, x):
+        out = self.quant1(torch.relu(self.conv1(x)))
+        out = self.conv2(out)
+        sc = x if self.shortcut is None else self.quant_sc(self.shortcut(x))
+        return self.quant2(torch.relu(out + sc))
+
+class ResNet(WAGENet):
+    """CIFAR ResNet with depth = 6n+2 and basic blocks of width `width`, 2`width`, 4`width`"""
+    def __init__(self, wl_activate=-1, fl_activate=-1, wl_error=-1, fl_error=-1,
+                 num_classes=10, depth=20, batch_norm=False, wl_weight=-1, writer=None,
+                 fused=False, telemetry=None, bits=None, width=16):
+        super(ResNet, self).__init__()
+        no_batch_norm(batch_norm)
+        assert (depth - 2) % 6 == 0, "depth should be 6n+2"
+        n = (depth - 2) // 6
+        quant, loss_quant = quantizers(wl_activate, wl_error, bits, writer, fused, telemetry)
+
+        self.stem = nn.Sequential(
+            nn.Conv2d(3, width, kernel_size=3, padding=1, bias=False),
+            nn.ReLU(inplace=True),
+            quant("stem"))
+        blocks, in_planes = [], width
+        for stage in range(3):
+            planes = width * 2**stage
+            for i in range(n):
+                stride = 2 if stage > 0 and i == 0 else 1
+                blocks.append(BasicBlock(in_planes, planes, stride, quant,
+                                         "block-%d-%d" % (stage + 1, i + 1)))
+                in_planes = planes
+        self.blocks = nn.Sequential(*blocks)
+        self.pool = nn.Sequential(nn.AdaptiveAvgPool2d(1), quant("pool"))
+        self.classifier = nn.Sequential(
+            nn.Linear(in_planes, num_classes, bias=False),
+            loss_quant())
+        self.init_wage(wl_weight, bits)
+
+    def forward(self, x):
+        with self.saved_codes():
+            x = self.stem(x)
+            for block in self.blocks: x = self.run_group(block, x)
+            x = torch.flatten(self.pool(x), 1)
+            return self.classifier(x)
+
+class MLP(WAGENet):
+    """
+    Fully connected WAGE network on the flattened image. Empty features and a
+    classifier, so it packs like VGG (see export_packed).
+    """
+    def __init__(self, wl_activate=-1, fl_activate=-1, wl_error=-1, fl_error=-1,
+                 num_classes=10, depth=3, batch_norm=False, wl_weight=-1, writer=None,
+                 fused=False, telemetry=None, bits=None, width=1024, in_features=3*32*32):
+        super(MLP, self).__init__()
+        no_batch_norm(batch_norm)
+        quant, loss_quant = quantizers(wl_activate, wl_error, bits, writer, fused, telemetry)
+        layers = []
+        for i in range(depth - 1):
+            layers += [nn.Linear(in_features, width, bias=False),
+                       nn.ReLU(inplace=True),
+                       quant("fc-%d" % (i + 1))]
+            in_features = width
+        layers += [nn.Linear(in_features, num_classes, bias=False), loss_quant()]
+        self.features = nn.Sequential()
+        self.classifier = nn.Sequential(*layers)
+        self.init_wage(wl_weight, bits)
+
+    def forward(self, x):
+        with self.saved_codes():
+            return self.classifier(torch.flatten(x, 1))
+
+class ResNet8LP:
+    base = ResNet
+    args = list()
+    kwargs = {'depth':8}
+
+class ResNet20LP:
+    base = ResNet
+    args = list()
+    kwargs = {'depth':20}
+
+class MLP3LP:
+    base = MLP
+    args = list()
+    kwargs = {'depth':3}
@@ -0,0 +1,80 @@
+import torch
+from collections.abc import MutableMapping
+from .wage_quantizer import S, C_bounds, SR_, max_shift, saturate_
+
+__all__ = ['QG_codes', 'round_shift', 'IntCodedAcc']
+
+def QG_codes(x, bits_G, bits_R, lr, divisor=None):
+    """
+    QG(x, bits_G, bits_R, lr) * S(bits_G), as integer codes. divisor replaces
+    shift(max|x|), e.g. with the shift of the largest max of all ranks
+    """
+    x /= max_shift(x) if divisor is None else divisor
+    saturate_(x)
+    norm = SR_(lr * x, bits_R)
+    return norm.to(torch.int8 if lr < 64 else torch.int16)
+
+def round_shift(x, k):
+    """round(x / 2**k) on integer tensors, ties to even like torch.round"""
+    if k <= 0: return x << -k
+    q = x >> k
+    r = x - (q << k)
+    half = 1 << (k-1)
+    return q + ((r > half) | ((r == half) & (q & 1).bool())).to(x.dtype)
+
+class IntCodedAcc(MutableMapping):
+    """
+    weight_acc stored as int16 codes (int32 above 15 gradient bits, where
+    |acc| = 1 no longer fits) with the shared exponent -(bits_G-1).
+    Reading an entry decodes it to float, so code that treats weight_acc as a
+    dict keeps working; the training loop uses accumulate() and project(), which
+    stay in integer arithmetic and are bit-identical to the float emulation.
+    """
+    def __init__(self, weight_acc, bits_W, bits_G):
+        assert bits_G >= bits_W, "accumulators must be at least as precise as weights"
+        assert bits_G <= 24, "accumulator codes must decode exactly to fp32"
+        self.bits_W = bits_W
+        self.bits_G = bits_G
+        self.dtype = torch.int16 if bits_G <= 15 else torch.int32
+        lower, upper = C_bounds(bits_W)
+        self.lower, self.upper = int(lower * S(bits_G)), int(upper * S(bits_G))
+        self.codes = {}
+        for name, acc in weight_acc.items():
+            self[name] = acc
+
+    def __getitem__(self, name):
+        return self.codes[name].float() / S(self.bits_G)
+
+    def __setitem__(self, name, acc):
+        codes = acc * S(self.bits_G)
+        assert torch.equal(codes, codes.round()), "%s is off the 1/S(bits_G) grid" % name
+        self.codes[name] = codes.to(self.dtype)
+
+    def __delitem__(self, name):
+        del self.codes[name]
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _apply(self, fn):
+        for name, codes in self.codes.items():
+            self.codes[name] = fn(codes)
+
+    def accumulate(self, name, grad_codes):
+        """C(acc, bits_W) - grad, with the gradient given as QG_codes"""
+        self.codes[name].clamp_(self.lower, self.upper).sub_(grad_codes)
+
+    def project(self, name, scale=1.0):
+        """QW(acc, bits_W, scale)"""
+        codes = self.codes[name].clamp(self.lower, self.upper)
+        if self.bits_W == 1:
+            y = torch.sign(codes).float()
+        elif self.bits_W > 15:
+            y = codes.float() / S(self.bits_G)
+        else:
+            y = round_shift(codes, self.bits_G - self.bits_W).float() / S(self.bits_W)
+        if scale>1.8: y /= scale
+        return y
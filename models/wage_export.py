@@ -0,0 +1,104 @@
+"""
+    TorchScript/ONNX export of trained WAGE models. The graph only has standard
+    ops: conv/linear on the integer weight codes, max-pool, relu, and every
+    WAGEQuantizer as mul + clip + round with its power-of-two scale baked in.
+    The bit widths and exponents are attached as metadata.
+"""
+import json
+import torch
+import torch.nn as nn
+from .wage_quantizer import S
+from .wage_packed import _ops, unpack_ternary
+
+__all__ = ['QuantClamp', 'Rescale', 'inference_net', 'export_torchscript', 'export_onnx',
+           'onnx_session']
+
+class QuantClamp(nn.Module):
+    """C and Q of the accumulator in one step: the integer codes of the next layer"""
+    def __init__(self, scale, bound):
+        super(QuantClamp, self).__init__()
+        self.scale = float(scale)
+        self.bound = float(bound)
+
+    def forward(self, x):
+        return torch.round(torch.clamp(x * self.scale, -self.bound, self.bound))
+
+class Rescale(nn.Module):
+    """codes of the last layer -> values"""
+    def __init__(self, scale):
+        super(Rescale, self).__init__()
+        self.scale = float(scale)
+
+    def forward(self, x):
+        return x * self.scale
+
+def _source_ops(source):
+    if not isinstance(source, dict): return _ops(source)
+    return [dict(op, codes=unpack_ternary(op['packed'], op['shape'])) if 'packed' in op else op
+            for op in source['ops']]
+
+def inference_net(source):
+    """
+    (net, metadata) for a WAGE model or a packed export (see export_packed).
+    net takes the images scaled to [-1, 1] like utils.eval and computes the
+    same values as TernaryEngine; layers keep their own weight bits. The sums
+    are exact in fp32 while the accumulator bound in the metadata is below 2**24.
+    """
+    modules, layers, exp, bound = [], [], 0, None
+    for op in _source_ops(source):
+        kind = op['type']
+        if kind in ('conv', 'linear'):
+            shape = op['shape']
+            if kind == 'conv':
+                m = nn.Conv2d(shape[1], shape[0], shape[2:], stride=op['stride'],
+                              padding=op['padding'], bias=False)
+            else:
+                m = nn.Linear(shape[1], shape[0], bias=False)
+            m.weight.data.copy_(op['codes'].float().view(shape))
+            fan_in = torch.Size(shape[1:]).numel()
+            layers.append({'name': op['name'], 'type': kind, 'shape': list(shape),
+                           'bits_W': op.get('bits_W', 2), 'w_exp': op['w_exp'],
+                           'accumulator_bound': None if bound is None else bound * fan_in})
+            exp, bound = exp + op['w_exp'], None
+        elif kind == 'maxpool':
+            m = nn.MaxPool2d(op['kernel_size'], op['stride'])
+        elif kind == 'relu':
+            m = nn.ReLU()
+        elif kind == 'quant':
+            bits = op['bits']
+            m = QuantClamp(2.**(bits-1-exp), S(bits)-1)
+            layers.append({'type': 'quant', 'bits_A': bits, 'scale_exp': bits-1-exp})
+            exp, bound = bits-1, S(bits)-1
+        elif kind == 'flatten':
+            m = nn.Flatten()
+        modules.append(m)
+    modules.append(Rescale(2.**-exp))
+    net = nn.Sequential(*modules).eval()
+    net.requires_grad_(False)
+    metadata = {'input': 'float32 NCHW images scaled to [-1, 1]', 'layers': layers,
+                'output_exp': exp}
+    return net, metadata
+
+def export_torchscript(net, metadata, path):
+    """metadata goes to the extra file wage.json, see torch.jit.load(_extra_files=...)"""
+    scripted = torch.jit.script(net)
+    torch.jit.save(scripted, path, _extra_files={'wage.json': json.dumps(metadata)})
+    return scripted
+
+def export_onnx(net, metadata, path, input_shape=(3, 32, 32), opset=13):
+    """dynamic batch size, metadata as the model property 'wage' (needs onnx)"""
+    import onnx
+    torch.onnx.export(net, torch.zeros(1, *input_shape), path, input_names=['image'],
+                      output_names=['output'], opset_version=opset,
+                      dynamic_axes={'image': {0: 'batch'}, 'output': {0: 'batch'}})
+    model = onnx.load(path)
+    onnx.helper.set_model_props(model, {'wage': json.dumps(metadata)})
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+def onnx_session(path, threads=0):
+    """onnxruntime CPU session of an export_onnx file (needs onnxruntime)"""
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if threads > 0: options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
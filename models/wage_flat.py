@@ -0,0 +1,85 @@
+import torch
+from .wage_quantizer import S, C, C_bounds, Q, SR_, max_shift, saturate_
+from .wage_rng import set_sr_layer
+
+__all__ = ['FlatWAGE']
+
+def _views(flat, params):
+    views, offset = [], 0
+    for p in params:
+        assert p.is_contiguous() or p.is_contiguous(memory_format=torch.channels_last)
+        # same strides as the parameter, so channels-last layouts are kept
+        views.append(flat.as_strided(p.size(), p.stride(), offset))
+        offset += p.numel()
+    return views
+
+class FlatWAGE(object):
+    """
+    Keeps weight_acc, the quantized weights and the gradients of all layers in
+    three flat buffers. model.weight_acc, param.data and param.grad become
+    views into them, and the WAGE update runs on the whole buffer at once.
+    """
+    def __init__(self, model, bits_W, bits_G, bits_R=-1):
+        self.bits_W = bits_W
+        self.bits_G = bits_G
+        self.bits_R = bits_R
+        self.lr = 1.0
+        names, params = zip(*model.named_parameters())
+        ref = params[0]
+        numel = sum(p.numel() for p in params)
+        self.acc = ref.new_empty(numel)
+        self.weight = ref.new_empty(numel)
+        self.grad = ref.new_zeros(numel)
+        self.acc_views = _views(self.acc, params)
+        self.weight_views = _views(self.weight, params)
+        self.grad_views = _views(self.grad, params)
+        for name, param, acc, weight, grad in zip(
+                names, params, self.acc_views, self.weight_views, self.grad_views):
+            acc.copy_(model.weight_acc[name])
+            weight.copy_(param.data)
+            model.weight_acc[name] = acc
+            param.data = weight
+            param.grad = grad
+        self.lengths = torch.tensor([p.numel() for p in params], device=ref.device)
+        # weight holds the projection of acc at version projected
+        self.version, self.projected = 0, None
+        model.wage_flat = self
+        # per layer scaling of QW, only applied when scale > 1.8
+        self.scaled = [(w, model.weight_scale[name])
+                       for name, w in zip(names, self.weight_views)
+                       if model.weight_scale[name] > 1.8]
+
+    def project(self):
+        """QW for every layer, skipped when acc did not change since the last call"""
+        if self.projected == self.version: return
+        self.projected = self.version
+        if self.bits_W == 1 or self.bits_W > 15:
+            self.weight.copy_(Q(C(self.acc, self.bits_W), self.bits_W))
+        else:
+            lower, upper = C_bounds(self.bits_W)
+            torch.clamp(self.acc, lower, upper, out=self.weight)
+            self.weight.mul_(S(self.bits_W)).round_().div_(S(self.bits_W))
+        if len(self.scaled) > 0:
+            views, scales = zip(*self.scaled)
+            torch._foreach_div_(list(views), list(scales))
+
+    def zero_grad(self):
+        self.grad.zero_()
+
+    def step(self):
+        """QG for every layer, then clip and accumulate"""
+        maxes = lambda views: torch.stack([torch.linalg.vector_norm(g, float('inf'))
+                                           for g in views])
+        divisor = max_shift(self.grad_views, maxes).repeat_interleave(
+            self.lengths, output_size=self.grad.numel())
+        grad = saturate_(self.grad.div_(divisor)).mul_(self.lr)
+        # one SR call over the flat buffer, keyed as a single layer
+        set_sr_layer('flat')
+        SR_(grad, self.bits_R).div_(S(self.bits_G))
+        # WAGE accumulate weight in gradient precision
+        lower, upper = C_bounds(self.bits_W)
+        self.acc.clamp_(lower, upper).sub_(grad)
+        self.version += 1
+
+    def invalidate(self):
+        self.projected = None
@@ -0,0 +1,63 @@
+import torch
+from .wage_quantizer import S, C_bounds, Q, QW, QE, QG, SR_, max_shift, shift_limit
+
+__all__ = ['set_fused_backend', 'Q_fused', 'QW_fused', 'QE_fused', 'QG_fused']
+
+# In-place kernels, bit-exact with the reference C/Q/QW/QE/QG: the same
+# operations in the same order, but written into one buffer. Eagerly they
+# allocate nothing; under torch.compile each one becomes a single loop.
+def _cq_(x, lower: float, upper: float, scale: float):
+    return x.clamp_(lower, upper).mul_(scale).round_().div_(scale)
+
+def _qe_(x, divisor, lower: float, upper: float, scale: float):
+    return x.div_(divisor).clamp_(lower, upper).mul_(scale).round_().div_(scale)
+
+def _qg_(x, divisor, bits_R: int, lr: float, scale: float, limit: float):
+    # SR_ is either one add_/floor_ or the chunked counter RNG
+    x.div_(divisor)
+    # limit is inf unless the shift is predicted, see saturate_
+    if limit != float('inf'): x.clamp_(-limit, limit)
+    return SR_(x.mul_(lr), bits_R).div_(scale)
+
+_kernels = {'cq': _cq_, 'qe': _qe_, 'qg': _qg_}
+
+def set_fused_backend(backend):
+    """'eager' runs the in-place chains as is, 'compile' fuses each of them
+    into a single pass with torch.compile (needs a C++ compiler on CPU)."""
+    global _kernels
+    if backend == 'eager':
+        _kernels = {'cq': _cq_, 'qe': _qe_, 'qg': _qg_}
+    elif backend == 'compile':
+        _kernels = {k: torch.compile(f, dynamic=True)
+                    for k, f in [('cq', _cq_), ('qe', _qe_), ('qg', _qg_)]}
+    else:
+        raise ValueError("unknown fused backend %s" % backend)
+
+def _abs_max(x):
+    # no full-size abs() temporary
+    lower, upper = torch.aminmax(x)
+    return torch.maximum(upper, -lower)
+
+def Q_fused(x, bits):
+    if bits == 1 or bits > 15: return Q(x, bits)
+    # one output buffer, rounded and rescaled in place; x is left as it is
+    return torch.mul(x, S(bits)).round_().div_(S(bits))
+
+def QW_fused(x, bits, scale=1.0, out=None):
+    if bits == 1 or bits > 15:
+        y = QW(x, bits, scale)
+        return y if out is None else out.copy_(y)
+    if out is None: out = torch.empty_like(x)
+    lower, upper = C_bounds(bits)
+    _kernels['cq'](out.copy_(x), lower, upper, S(bits))
+    if scale>1.8: out /= scale
+    return out
+
+def QE_fused(x, bits):
+    if bits == 1 or bits > 15: return QE(x, bits)
+    lower, upper = C_bounds(bits)
+    return _kernels['qe'](x, max_shift(x, _abs_max), lower, upper, S(bits))
+
+def QG_fused(x, bits_G, bits_R, lr):
+    return _kernels['qg'](x, max_shift(x, _abs_max), bits_R, lr, S(bits_G), shift_limit())
+
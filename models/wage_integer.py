@@ -0,0 +1,280 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .wage_quantizer import S, C_bounds, WAGEQuantizer
+from .wage_packed import _layers
+from .wage_rng import get_sr_rng, set_sr_layer
+
+__all__ = ['round_log2', 'round_shift_t', 'QE_int', 'QG_int', 'IntegerWAGE']
+
+# Integer-only WAGE: every tensor is an integer code x with an implicit
+# exponent, value = x * 2**-exp, and every rescaling is a bit shift. Since QE
+# and QG normalize by a power of two of their max, they do not need the
+# exponent of their input, and errors/gradients are kept as bare integers.
+
+def _pow2(k):
+    return torch.ones_like(k) << k
+
+# ceil(2**k * sqrt(2)): round(log2(m)) = k + 1 for 2**k <= m exactly when m reaches it
+_ROUND_UP = [math.isqrt(2**(2*k + 1)) + 1 for k in range(63)]
+
+def round_log2(m):
+    """round(log2(m)) of a positive int64 tensor, exact; 0 for m == 0"""
+    m = m.clamp(min=1)
+    # float64 rounds m above 2**53, possibly up to the next power of two
+    k = torch.floor(torch.log2(m.double())).long().clamp_(max=62)
+    k = k - (m < _pow2(k)).long()
+    # compare with a table instead of m**2 >= 2**(2k+1), which overflows int64
+    return k + (m >= torch.tensor(_ROUND_UP, device=m.device)[k]).long()
+
+def round_shift_t(x, k):
+    """round(x / 2**k) for a tensor exponent k of any sign, ties to even like torch.round"""
+    x = x << (-k).clamp(min=0)
+    k = k.clamp(min=0)
+    q = x >> k
+    r = x - (q << k)
+    half = _pow2(k) >> 1
+    up = (r > half) | ((r == half) & (q & 1).bool() & (k > 0))
+    return q + up.to(x.dtype)
+
+def QE_int(x, bits):
+    """QE on integer codes: int codes of Q(C(x / shift(max|x|))), zero stays zero"""
+    r = round_log2(x.abs().amax())
+    bound = int(S(bits)) - 1
+    return round_shift_t(x, r - (bits-1)).clamp_(-bound, bound)
+
+def QG_int(x, bits_R, lr_exp):
+    """
+    QG on integer codes, as codes on the 1/S(bits_G) grid:
+    SR(x / shift(max|x|) * 2**lr_exp). The stochastic rounding compares the
+    remainder of the shift with bits_R random bits, capped so nothing
+    overflows int64.
+    """
+    k = round_log2(x.abs().amax()) - lr_exp
+    bits = 24 if bits_R == -1 else min(bits_R, 24)
+    rng = get_sr_rng()
+    if rng is not None:
+        u = rng.integers(x.shape, x.device) >> (rng.bits - bits if rng.bits > bits else 0)
+        bits = min(bits, rng.bits)
+    else:
+        u = torch.randint(0, 2**bits, x.shape, dtype=torch.int64, device=x.device)
+    if int(k) <= 0: return x << -k
+    b = (62 - k).clamp(min=0, max=bits)
+    u = u >> (bits - b)
+    q = x >> k
+    rem = x - (q << k)
+    return q + ((rem << b) + (u << k) >= _pow2(k + b)).long()
+
+def _im2col(x, kernel, padding):
+    """(N, C, H, W) -> (N*H'*W', C*k*k) rows for a stride 1 convolution"""
+    x = F.pad(x, (padding,)*4)
+    cols = x.unfold(2, kernel, 1).unfold(3, kernel, 1)
+    N, C, Ho, Wo = cols.shape[:4]
+    return cols.permute(0, 2, 3, 1, 4, 5).reshape(N*Ho*Wo, C*kernel*kernel), Ho, Wo
+
+def conv_int(x, w, padding, dtype, max_rows=2**16):
+    """stride 1 conv2d as im2col + integer matmul, in row chunks to bound the im2col buffer"""
+    N, kernel = x.size(0), w.size(-1)
+    w = w.reshape(w.size(0), -1).t().to(dtype)
+    per_sample = x.size(2) * x.size(3)
+    step = max(1, max_rows // per_sample)
+    outs = []
+    for start in range(0, N, step):
+        cols, Ho, Wo = _im2col(x[start:start+step].to(dtype), kernel, padding)
+        outs.append((cols @ w).view(-1, Ho, Wo, w.size(1)))
+    return torch.cat(outs).permute(0, 3, 1, 2)
+
+def conv_int_weight_grad(x, e, kernel, padding, max_rows=2**16):
+    """sum over the batch of e (N, O, H', W') x im2col(x), as int64 (O, C, k, k)"""
+    N, C = x.shape[:2]
+    per_sample = e.size(2) * e.size(3)
+    step = max(1, max_rows // per_sample)
+    grad = None
+    for start in range(0, N, step):
+        cols, _, _ = _im2col(x[start:start+step].long(), kernel, padding)
+        e_rows = e[start:start+step].permute(0, 2, 3, 1).reshape(-1, e.size(1)).long()
+        g = e_rows.t() @ cols
+        grad = g if grad is None else grad + g
+    return grad.view(e.size(1), C, kernel, kernel)
+
+def _pool_windows(x):
+    # (N, C, H, W) -> (N, C, H/2, W/2, 4), row-major in each 2x2 window
+    N, C, H, W = x.shape
+    return x.unfold(2, 2, 2).unfold(3, 2, 2).reshape(N, C, H // 2, W // 2, 4)
+
+def _pool_grad(g, idx):
+    N, C, Ho, Wo = g.shape
+    full = g.new_zeros(N, C, Ho, Wo, 4).scatter_(-1, idx.long().unsqueeze(-1), g.unsqueeze(-1))
+    return full.view(N, C, Ho, Wo, 2, 2).permute(0, 1, 2, 4, 3, 5).reshape(N, C, 2*Ho, 2*Wo)
+
+class IntegerWAGE(object):
+    """
+    Bit-accurate integer-only training of a features/classifier WAGE model
+    (VGG, MLP) on CPU: int8 activation and error codes, int16 accumulators on
+    the 1/S(bits_G) grid, int32/int64 conv and matmul accumulators chosen per
+    layer so they cannot overflow, and QE/QG/requantization as bit shifts.
+    Forward, QE and the weight/accumulator updates match the fp32 reference
+    bit for bit. SR draws its own integers, so gradients match in distribution.
+    The images enter as codes of Q(C(2x-1, input_bits)), so the fp32 model
+    computes the same only on images already on that grid (--data-quantize).
+    """
+    def __init__(self, model, bits_W, bits_G, bits_R=-1, input_bits=8):
+        assert 1 < bits_W <= bits_G <= 15, "integer weights and accumulators need 2 <= bits_W <= bits_G <= 15"
+        assert 1 < input_bits <= 8, "the integer engine needs int8 input codes"
+        self.bits_W, self.bits_G, self.bits_R = bits_W, bits_G, bits_R
+        self.input_bits = input_bits
+        lower, upper = C_bounds(bits_W)
+        self.lower, self.upper = int(lower * S(bits_G)), int(upper * S(bits_G))
+        params = dict(model.named_parameters())
+        names = {param: name for name, param in params.items()}
+        # codes entering the next conv/linear are bounded by S(bits)-1
+        self.ops, self.acc, self.w_exp, in_bound = [], {}, {}, S(input_bits) - 1
+        for m in _layers(model):
+            if isinstance(m, (nn.Conv2d, nn.Linear)):
+                name = names[m.weight]
+                if isinstance(m, nn.Conv2d):
+                    assert m.stride == (1, 1) and m.kernel_size[0] == m.kernel_size[1], \
+                        "only square stride 1 convolutions"
+                    op = {'type': 'conv', 'padding': m.padding[0], 'kernel': m.kernel_size[0]}
+                else:
+                    op = {'type': 'linear'}
+                scale = model.weight_scale[name]
+                # QW divides by the (power of two) layer scale only above 1.8
+                self.w_exp[name] = (bits_W - 1) + (int(round(math.log2(scale))) if scale > 1.8 else 0)
+                fan_in = m.weight[0].numel()
+                # an unquantized activation (bits_A = -1) would not be integer codes
+                assert in_bound is not None, "%s: the integer engine needs quantized inputs" % name
+                bound = in_bound * (S(bits_W) - 1) * fan_in
+                op.update(name=name, dtype=torch.int32 if bound < 2**31 else torch.int64)
+                self.ops.append(op)
+                in_bound = None
+            elif isinstance(m, nn.MaxPool2d):
+                assert m.kernel_size == 2 and m.stride == 2, "only 2x2 max pooling"
+                self.ops.append({'type': 'maxpool'})
+            elif isinstance(m, nn.ReLU):
+                self.ops.append({'type': 'relu'})
+            elif isinstance(m, WAGEQuantizer):
+                assert m.bits_E != -1, "the integer engine needs quantized errors"
+                self.ops.append({'type': 'quant', 'bits_A': m.bits_A, 'bits_E': m.bits_E})
+                if m.bits_A != -1: in_bound = S(m.bits_A) - 1
+            elif m is None:
+                self.ops.append({'type': 'flatten'})
+            else:
+                raise NotImplementedError("no integer %s" % type(m).__name__)
+        self.load(model)
+
+    def load(self, model):
+        """take the accumulators of model.weight_acc as int16 codes"""
+        for name in self.w_exp:
+            codes = model.weight_acc[name].detach().cpu() * S(self.bits_G)
+            assert torch.equal(codes, codes.round()), "%s is off the 1/S(bits_G) grid" % name
+            self.acc[name] = codes.to(torch.int16)
+
+    def store(self, model):
+        """write the accumulators back into model.weight_acc"""
+        for name, codes in self.acc.items():
+            model.weight_acc[name] = model.weight_acc[name].copy_(codes.float() / S(self.bits_G))
+        model.invalidate_weights()
+
+    def weight(self, name):
+        """QW codes: C(acc) rounded from the gradient grid to the weight grid"""
+        acc = self.acc[name].long().clamp_(self.lower, self.upper)
+        return round_shift_t(acc, torch.tensor(self.bits_G - self.bits_W))
+
+    def input_codes(self, x, bits):
+        """[0-1] images -> codes of Q(C(2x-1, bits)), and their exponent"""
+        lower, upper = C_bounds(bits)
+        return torch.round(torch.clamp(x*2-1, lower, upper) * S(bits)).to(torch.int8), bits - 1
+
+    def forward(self, x, exp, saved=None):
+        """logit codes (int64) and their exponent; fills saved for backward"""
+        for op in self.ops:
+            kind = op['type']
+            if kind in ('conv', 'linear'):
+                w = self.weight(op['name'])
+                if saved is not None: saved.append(x)
+                if kind == 'conv':
+                    x = conv_int(x, w, op['padding'], op['dtype'])
+                else:
+                    x = x.to(op['dtype']) @ w.t().to(op['dtype'])
+                exp = exp + self.w_exp[op['name']]
+            elif kind == 'maxpool':
+                x, idx = _pool_windows(x).max(-1)
+                if saved is not None: saved.append(idx.to(torch.uint8))
+            elif kind == 'relu':
+                x = x.clamp(min=0)
+                if saved is not None: saved.append(x > 0)
+            elif kind == 'quant' and op['bits_A'] != -1:
+                bits = op['bits_A']
+                bound = int(S(bits)) - 1
+                # C passes the gradient where |x * 2**-exp| <= 1 - 1/S
+                x = x.long()
+                if saved is not None:
+                    limit = bound << max(exp - (bits-1), 0)
+                    saved.append((x.abs() << max((bits-1) - exp, 0)) <= limit)
+                x = round_shift_t(x, torch.tensor(exp - (bits-1))).clamp_(-bound, bound)
+                x, exp = x.to(torch.int8 if bits <= 8 else torch.int16), bits - 1
+            elif kind == 'flatten':
+                if saved is not None: saved.append(x.shape)
+                x = torch.flatten(x, 1)
+        return x.long(), exp
+
+    def backward(self, g, saved):
+        """integer weight gradients (int64) for an integer error g at the logits"""
+        grads = {}
+        for i, op in reversed(list(enumerate(self.ops))):
+            kind = op['type']
+            if kind == 'quant':
+                g = QE_int(g, op['bits_E'])
+                if op['bits_A'] != -1: g = g * saved.pop()
+            elif kind == 'relu':
+                g = g * saved.pop()
+            elif kind == 'maxpool':
+                g = _pool_grad(g, saved.pop())
+            elif kind == 'flatten':
+                g = g.view(saved.pop())
+            else:
+                x = saved.pop()
+                w = self.weight(op['name'])
+                if kind == 'conv':
+                    grads[op['name']] = conv_int_weight_grad(x, g, op['kernel'], op['padding'])
+                    if i > 0:
+                        # the input gradient is the conv of g with the flipped, transposed kernel
+                        w_t = w.flip(-1, -2).transpose(0, 1)
+                        g = conv_int(g, w_t, op['kernel'] - 1 - op['padding'], torch.int64)
+                else:
+                    grads[op['name']] = g.t() @ x.long()
+                    if i > 0: g = g @ w
+        return grads
+
+    def step(self, x, target, lr):
+        """one training step on [0-1] images; returns loss, top-1 and in_top_k counts"""
+        lr_exp = round(math.log2(lr))
+        assert 2.**lr_exp == lr, "the integer engine needs a power of two learning rate"
+        saved = []
+        x, exp = self.input_codes(x, self.input_bits)
+        logits, exp = self.forward(x, exp, saved)
+        # dL/dlogits = logits - onehot, on the grid of the logits
+        onehot = torch.zeros_like(logits).scatter_(1, target.view(-1, 1), 1 << exp)
+        g = logits - onehot
+        grads = self.backward(g, saved)
+        for name, grad in grads.items():
+            set_sr_layer(name)
+            codes = QG_int(grad, self.bits_R, lr_exp)
+            acc = self.acc[name].int().clamp_(self.lower, self.upper)
+            self.acc[name] = (acc - codes.view_as(acc).int()).to(torch.int16)
+        return self.metrics(logits, exp, target)
+
+    def metrics(self, logits, exp, target):
+        values = logits.double() * 2.**-exp
+        loss = 0.5 * ((values - F.one_hot(target, values.size(1)).double())**2).sum()
+        label_logit = logits.gather(1, target.view(-1, 1)).view(-1)
+        max_logit, pred = logits.max(1)
+        return loss, (pred == target).sum(), (label_logit == max_logit).sum()
+
+    def predict(self, x):
+        """logits as floats, like the model"""
+        x, exp = self.input_codes(x, self.input_bits)
+        logits, exp = self.forward(x, exp)
+        return logits.double() * 2.**-exp
@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+import torch
+from torch.autograd.graph import saved_tensors_hooks
+
+__all__ = ['mark_codes', 'saved_codes', 'recomputed', 'is_recomputing']
+
+_recomputing = False
+
+def mark_codes(y, bits):
+    """tag y as lying on the 1/S(bits) grid, so autograd may keep it as int8"""
+    if 1 < bits <= 8: y._wage_bits = bits
+    return y
+
+def _bits(t):
+    bits = getattr(t, '_wage_bits', None)
+    # e.g. the flattened input of the first linear is a view of a quantizer output
+    if bits is None and t._base is not None: bits = getattr(t._base, '_wage_bits', None)
+    return bits
+
+def _pack(t):
+    bits = _bits(t)
+    if bits is None: return t
+    scale = 2.**(bits-1)
+    return (t.mul(scale).to(torch.int8), scale, t.dtype)
+
+def _unpack(packed):
+    if isinstance(packed, torch.Tensor): return packed
+    codes, scale, dtype = packed
+    return codes.to(dtype).div_(scale)
+
+def recomputed(fn):
+    """
+    fn for torch.utils.checkpoint: the first call runs it as is, later calls
+    (the recompute in backward) with is_recomputing() set
+    """
+    calls = [0]
+    def run(*args):
+        global _recomputing
+        calls[0] += 1
+        if calls[0] == 1: return fn(*args)
+        previous, _recomputing = _recomputing, True
+        try:
+            return fn(*args)
+        finally:
+            _recomputing = previous
+    return run
+
+def is_recomputing():
+    """whether a checkpointed group is recomputing its forward, e.g. to skip telemetry"""
+    return _recomputing
+
+@contextmanager
+def saved_codes(enabled=True):
+    """store the quantized activations autograd saves (conv/linear inputs) as int8 codes"""
+    if not enabled:
+        yield
+        return
+    with saved_tensors_hooks(_pack, _unpack):
+        yield
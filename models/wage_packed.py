@@ -0,0 +1,170 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .wage_quantizer import WAGEQuantizer, S, C, Q
+
+__all__ = ['pack_ternary', 'unpack_ternary', 'export_packed', 'TernaryEngine']
+
+def pack_ternary(t):
+    """{-1, 0, 1} -> 2-bit two's complement codes, 4 per byte"""
+    codes = (t.reshape(-1).to(torch.int8) & 3).to(torch.uint8)
+    pad = (-codes.numel()) % 4
+    codes = torch.cat([codes, codes.new_zeros(pad)]).view(-1, 4)
+    return codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) | (codes[:, 3] << 6)
+
+def unpack_ternary(packed, shape):
+    codes = torch.stack([(packed >> s) & 3 for s in (0, 2, 4, 6)], 1).view(-1)
+    codes = codes[:torch.Size(shape).numel()].to(torch.int8)
+    # sign-extend the 2-bit codes: 3 -> -1
+    return (codes - ((codes >> 1) << 2)).view(shape)
+
+def _layers(model):
+    if not (hasattr(model, 'features') and hasattr(model, 'classifier')):
+        raise NotImplementedError("only features/classifier models can be packed")
+    for m in model.features: yield m
+    yield None # flatten
+    for m in model.classifier: yield m
+
+def _ops(model, bits_W=None):
+    """
+    The inference ops of a features/classifier model. Conv/linear ops carry the
+    integer codes of the projection of weight_acc and its power-of-two
+    exponent: w = codes * 2**-w_exp. bits_W=None uses the bits of each layer.
+    """
+    ops = []
+    params = dict(model.named_parameters())
+    names = {param: name for name, param in params.items()}
+    for m in _layers(model):
+        if isinstance(m, (nn.Conv2d, nn.Linear)):
+            name = names[m.weight]
+            bits = model.wl_weight[name] if bits_W is None else bits_W
+            scale = model.weight_scale[name]
+            codes = Q(C(model.weight_acc[name], bits), bits) * S(bits)
+            # QW divides by the (power of two) layer scale only above 1.8
+            w_exp = (bits - 1) + (int(round(math.log2(scale))) if scale > 1.8 else 0)
+            op = {'type': 'conv' if isinstance(m, nn.Conv2d) else 'linear', 'name': name,
+                  'codes': codes.cpu(), 'shape': tuple(codes.shape), 'bits_W': bits,
+                  'w_exp': w_exp}
+            if isinstance(m, nn.Conv2d):
+                op.update(stride=m.stride, padding=m.padding)
+            ops.append(op)
+        elif isinstance(m, nn.MaxPool2d):
+            ops.append({'type': 'maxpool', 'kernel_size': m.kernel_size, 'stride': m.stride})
+        elif isinstance(m, nn.ReLU):
+            ops.append({'type': 'relu'})
+        elif isinstance(m, WAGEQuantizer):
+            if m.bits_A != -1: ops.append({'type': 'quant', 'bits': m.bits_A})
+        elif m is None:
+            ops.append({'type': 'flatten'})
+        else:
+            raise NotImplementedError("cannot pack %s" % type(m).__name__)
+    return ops
+
+def export_packed(model, bits_W):
+    """
+    Export the ternary projection of weight_acc as 2-bit codes together with
+    the power-of-two exponent of every layer: w = code * 2**-w_exp.
+    """
+    ops = _ops(model, bits_W)
+    for op in ops:
+        if 'codes' in op:
+            codes = op.pop('codes')
+            assert codes.abs().max() <= 1, "only ternary weights can be packed"
+            op['packed'] = pack_ternary(codes)
+    return {'bits_W': bits_W, 'ops': ops}
+
+class TernaryEngine(nn.Module):
+    """
+    Inference on packed WAGE models. Activations are kept as int8 codes with
+    exponent bits_A-1, weights as ternary codes, and each layer rescales its
+    integer accumulator with a power of two before requantizing. The products
+    and sums are exact integers, so they run on the float conv/gemm kernels as
+    long as the accumulator stays below 2**24.
+
+    With sparse=True, layers with at least min_sparsity zero weights keep only
+    the +1/-1 entries as CSR index lists, and conv (im2col) and linear become
+    sparse adds and subtracts. The sums are the same exact integers.
+    """
+    def __init__(self, packed, sparse=False, min_sparsity=0.5):
+        super(TernaryEngine, self).__init__()
+        self.ops = packed['ops']
+        # zero fraction of every conv/linear, by op index
+        self.sparse, self.sparsity = {}, {}
+        for i, op in enumerate(self.ops):
+            if op['type'] in ('conv', 'linear'):
+                w = unpack_ternary(op['packed'], op['shape'])
+                self.sparsity[i] = float((w == 0).float().mean())
+                if sparse and self.sparsity[i] >= min_sparsity:
+                    csr = w.reshape(w.size(0), -1).float().to_sparse_csr()
+                    self.register_buffer('w%d_crow' % i, csr.crow_indices())
+                    self.register_buffer('w%d_col' % i, csr.col_indices())
+                    self.register_buffer('w%d_val' % i, csr.values())
+                    self.sparse[i] = True
+                else:
+                    self.register_buffer('w%d' % i, w.float())
+
+    def _csr(self, i):
+        shape = self.ops[i]['shape']
+        return torch.sparse_csr_tensor(getattr(self, 'w%d_crow' % i), getattr(self, 'w%d_col' % i),
+                                       getattr(self, 'w%d_val' % i),
+                                       size=(shape[0], math.prod(shape[1:])))
+
+    def _sparse_conv(self, x, i, max_rows=2**16):
+        op = self.ops[i]
+        w = self._csr(i)
+        kernel = op['shape'][2:]
+        outs = []
+        step = max(1, max_rows // (x.size(2) * x.size(3)))
+        for part in x.split(step):
+            cols = F.unfold(part, kernel, padding=op['padding'], stride=op['stride'])
+            N, K, L = cols.shape
+            out = torch.sparse.mm(w, cols.transpose(0, 1).reshape(K, N*L))
+            outs.append(out.view(-1, N, L).transpose(0, 1))
+        H = (x.size(2) + 2*op['padding'][0] - kernel[0]) // op['stride'][0] + 1
+        W = (x.size(3) + 2*op['padding'][1] - kernel[1]) // op['stride'][1] + 1
+        return torch.cat(outs).reshape(x.size(0), -1, H, W)
+
+    def sparsity_rows(self):
+        """[layer, shape, zero fraction, dense/sparse] rows for tabulate"""
+        return [[op['name'], 'x'.join(map(str, op['shape'])), self.sparsity[i],
+                 'sparse' if i in self.sparse else 'dense']
+                for i, op in enumerate(self.ops) if op['type'] in ('conv', 'linear')]
+
+    def forward(self, x, exp=0):
+        """
+        x: images scaled to [-1, 1], or with exp > 0 their codes on the
+        2**-exp grid, e.g. int8 codes with exp=7 as in the deployed int path
+        """
+        # the value of the activation is x * 2**-exp
+        bound = None if exp == 0 else 2**exp - 1
+        for i, op in enumerate(self.ops):
+            kind = op['type']
+            if kind in ('conv', 'linear'):
+                fan_in = math.prod(op['shape'][1:])
+                if bound is not None:
+                    assert bound * fan_in < 2**24, "accumulator overflow"
+                x = x.float()
+                if i in self.sparse:
+                    if kind == 'conv':
+                        x = self._sparse_conv(x, i)
+                    else:
+                        x = torch.sparse.mm(self._csr(i), x.t()).t()
+                elif kind == 'conv':
+                    x = F.conv2d(x, getattr(self, 'w%d' % i), stride=op['stride'], padding=op['padding'])
+                else:
+                    x = F.linear(x, getattr(self, 'w%d' % i))
+                exp, bound = exp + op['w_exp'], None
+            elif kind == 'maxpool':
+                x = F.max_pool2d(x, op['kernel_size'], op['stride'])
+            elif kind == 'relu':
+                x = F.relu(x)
+            elif kind == 'quant':
+                # C and Q in one step: clamp to +-(S-1) codes, round half to even
+                bits = op['bits']
+                x = torch.round(torch.clamp(x * 2.**(bits-1-exp), -(S(bits)-1), S(bits)-1))
+                if bits <= 8: x = x.to(torch.int8)
+                exp, bound = bits-1, S(bits)-1
+            elif kind == 'flatten':
+                x = torch.flatten(x, 1)
+        return x * 2.**-exp
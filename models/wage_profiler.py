@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import torch
+
+__all__ = ['Profiler', 'set_profiler', 'profile_region', 'profile_iter']
+
+_profiler = None
+
+@contextmanager
+def _null():
+    yield
+
+class Profiler(object):
+    """
+    Named timing regions on the training hot path, accumulated per epoch.
+    Regions also show up as record_function ranges when a torch.profiler
+    trace is running. With sync=True the device is synchronized at region
+    boundaries, so asynchronous CUDA work is charged to the right region.
+    """
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.trace = None
+        self.reset()
+
+    def reset(self):
+        self.totals = OrderedDict()
+        self.counts = OrderedDict()
+        self.steps = 0
+
+    def _synchronize(self):
+        if self.sync: torch.cuda.synchronize()
+
+    @contextmanager
+    def region(self, name):
+        with torch.profiler.record_function(name):
+            self._synchronize()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._synchronize()
+                self.totals[name] = self.totals.get(name, 0.) + time.perf_counter() - start
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def start_trace(self, path, wait=5, warmup=2, active=5):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available(): activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=lambda p: p.export_chrome_trace(path))
+        self.trace.start()
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+    def step(self):
+        self.steps += 1
+        if self.trace is not None: self.trace.step()
+
+    def rows(self, elapsed):
+        """[region, total s, ms per call, % of elapsed] rows for tabulate"""
+        return [[name, total, total / self.counts[name] * 1000., total / elapsed * 100.]
+                for name, total in self.totals.items()]
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+def profile_region(name):
+    if _profiler is None: return _null()
+    return _profiler.region(name)
+
+def profile_iter(iterable, name='data'):
+    """times how long each next() waits, e.g. on a DataLoader"""
+    if _profiler is None: return iterable
+    def timed():
+        it = iter(iterable)
+        while True:
+            _profiler.step()
+            with _profiler.region(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+    return timed()
@@ -3,25 +3,58 @@ import torch.nn as nn
 from torch.nn import Module
 import torch.nn.functional as F
 from torch.autograd import Function
+from .wage_profiler import profile_region
+from .wage_rng import get_sr_rng
+import math
+from .wage_shift import get_shift_predictor, shift_limit
+from .wage_memory import mark_codes, is_recomputing
 
 def shift(x):
-    #TODO: edge case, when x contains 0
-    return 2.**torch.round(torch.log2(x))
+    # an all-zero error/gradient has max 0: divide by 1 so it stays zero
+    # instead of turning into nan; QE and QG then return zeros
+    return torch.where(x == 0, torch.ones_like(x), 2.**torch.round(torch.log2(x)))
+
+def abs_max(x):
+    return x.abs().max()
+
+def max_shift(x, x_max=abs_max):
+    """shift(x_max(x)), or its prediction when a ShiftPredictor is set"""
+    predictor = get_shift_predictor()
+    if predictor is None: return shift(x_max(x))
+    return predictor.shift(x, x_max)
+
+def saturate_(x):
+    """clamp x / shift in QG to shift_limit(), a no-op without a ShiftPredictor"""
+    limit = shift_limit()
+    return x if limit == math.inf else x.clamp_(-limit, limit)
 
 def S(bits):
     return 2.**(bits-1)
 
-def SR(x):
-    r = torch.cuda.FloatTensor(*x.size()).uniform_()
-    return torch.floor(x+r)
+def SR(x, bits_R=-1):
+    return SR_(x.clone(), bits_R)
 
-def C(x, bits):
+def SR_(x, bits_R=-1):
+    """
+    x = floor(x + r) in place, r uniform. Like the original SR, the torch RNG
+    path draws fp32 uniforms whatever bits_R; only a CounterRNG (see
+    set_sr_rng) quantizes r to its bits_R
+    """
+    rng = get_sr_rng()
+    if rng is not None: return rng.sr_(x)
+    return x.add_(torch.rand_like(x)).floor_()
+
+def C_bounds(bits):
     if bits > 15 or bits == 1:
         delta = 0
     else:
         delta = 1. / S(bits)
     upper = 1  - delta
     lower = -1 + delta
+    return lower, upper
+
+def C(x, bits):
+    lower, upper = C_bounds(bits)
     return torch.clamp(x, lower, upper)
 
 def Q(x, bits):
@@ -39,66 +72,105 @@ def QW(x, bits, scale=1.0):
     return y
 
 def QE(x, bits):
-    max_entry = x.abs().max()
-    assert max_entry != 0, "QE blow"
-    x /= shift(max_entry)
+    x /= max_shift(x)
     return Q(C(x, bits), bits)
 
 def QG(x, bits_G, bits_R, lr):
-    max_entry = x.abs().max()
-    assert max_entry != 0, "QG blow"
-    x /= shift(max_entry)
+    x /= max_shift(x)
+    saturate_(x)
     norm = lr * x
-    norm = SR(norm)
+    norm = SR_(norm, bits_R)
     return norm / S(bits_G)
 
+def shift_exponent(x):
+    """exponent of shift(max|x|), the power of two QE/QG divide by"""
+    return torch.round(torch.log2(x.abs().max()))
+
+def quant_stats(x, y, bits):
+    """saturation of C, rounding error (in LSBs) and zero fraction of y = Q(C(x))"""
+    lower, upper = C_bounds(bits)
+    return {
+        'saturation': ((x < lower) | (x > upper)).float().mean(),
+        'round-error': (y - x.clamp(lower, upper)).abs().mean() * S(bits),
+        'zero-frac': (y == 0).float().mean(),
+    }
+
 class WAGERounding(Function):
+    """
+    Q(C(x)) forward, QE backward. The clamp happens here rather than through
+    torch.clamp, so only its bool mask is kept for backward, not the fp32 input.
+    """
     @staticmethod
-    def forward(self, x, bits_A, bits_E, optional):
+    def forward(self, x, bits_A, bits_E, optional, quant=Q, error_quant=QE, telemetry=None):
         self.optional = optional
         self.bits_E = bits_E
-        self.save_for_backward(x)
-
-        if bits_A == -1: ret = x
-        else: ret = Q(x, bits_A)
-
-        return ret
+        self.error_quant = error_quant
+        self.telemetry = telemetry
+
+        if bits_A == -1:
+            self.clamped = False
+            return x
+        lower, upper = C_bounds(bits_A)
+        # gradient of C: passes where lower <= x <= upper, like torch.clamp
+        self.clamped = True
+        self.save_for_backward((x >= lower) & (x <= upper))
+        return quant(torch.clamp(x, lower, upper), bits_A)
 
     @staticmethod
     def backward(self, grad_output):
-        if self.bits_E == -1: return grad_output, None, None, None
+        grad_input = WAGERounding.error_backward(self, grad_output)
+        if self.clamped and self.needs_input_grad[0]:
+            mask, = self.saved_tensors
+            grad_input = grad_input * mask
+        return grad_input, None, None, None, None, None, None
+
+    @staticmethod
+    def error_backward(self, grad_output):
+        if self.bits_E == -1: return grad_output
 
         if self.needs_input_grad[0]:
-            try:
-                grad_input = QE(grad_output, self.bits_E)
-            except AssertionError as e:
-                print("="*80)
-                print("Error backward:%s"%self.optional)
-                print("-"*80)
-                print(grad_output.max())
-                print(grad_output.min())
-                print("="*80)
-                raise e
+            sampled = self.telemetry is not None and self.telemetry.sampled(self.optional)
+            if sampled: exponent = shift_exponent(grad_output)
+            with profile_region('QE'):
+                grad_input = self.error_quant(grad_output, self.bits_E)
+            if sampled:
+                self.telemetry.record("error/%s" % self.optional,
+                                      {'shift': exponent, 'zero-frac': (grad_input == 0).float().mean()})
         else:
             grad_input = grad_output
 
-        return grad_input, None, None, None
+        return grad_input
 
 quantize_wage = WAGERounding.apply
 
 class WAGEQuantizer(Module):
-    def __init__(self, bits_A, bits_E, name="", writer=None):
+    def __init__(self, bits_A, bits_E, name="", writer=None, fused=False, telemetry=None):
         super(WAGEQuantizer, self).__init__()
         self.bits_A = bits_A
         self.bits_E = bits_E
         self.name = name
         self.writer = writer
+        self.telemetry = telemetry
+        self.quant, self.error_quant = Q, QE
+        if fused:
+            from .wage_fused import Q_fused, QE_fused
+            self.quant, self.error_quant = Q_fused, QE_fused
 
     def forward(self, x):
-        if self.bits_A != -1:
-            x = C(x, self.bits_A) #  keeps the gradients
-        y = quantize_wage(x, self.bits_A, self.bits_E, self.name)
+        x_in = x
+        # C is applied inside quantize_wage
+        y = quantize_wage(x, self.bits_A, self.bits_E, self.name,
+                          self.quant, self.error_quant, self.telemetry)
+        if self.bits_A != -1: mark_codes(y, self.bits_A)
+        # the recompute of a checkpointed group was already recorded in forward
+        if is_recomputing(): return y
+        if (self.training and self.bits_A != -1 and self.telemetry is not None
+                and self.telemetry.sampled(self.name)):
+            with torch.no_grad():
+                self.telemetry.record("activation/%s" % self.name,
+                                      quant_stats(x_in, y, self.bits_A))
         if self.writer is not None:
+            if self.bits_A != -1: x = C(x, self.bits_A)
             self.writer.add_histogram(
                     "activation-before/%s"%self.name, x.clone().cpu().data.numpy())
             self.writer.add_histogram(
@@ -111,11 +183,8 @@ if __name__ == "__main__":
     shape = (5,5)
     # test QG
     test_data = np.random.rand(*shape)
-    r = np.random.rand(*shape)
     print(test_data*10)
-    print(r*10)
     test_tensor = torch.from_numpy(test_data).float()
-    rand_tensor = torch.from_numpy(r).float()
     lr = 2
     bits_W = 2
     bits_G = 8
@@ -125,13 +194,14 @@ if __name__ == "__main__":
     print("="*80)
     print("Gradient")
     print("="*80)
-    quant_data = QG(test_tensor, bits_G, bits_R, lr, rand_tensor).data.numpy()
+    # QG and QE normalize their input in place
+    quant_data = QG(test_tensor.clone(), bits_G, bits_R, lr).data.numpy()
     print(quant_data)
     # test QA
     print("="*80)
     print("Activation")
     print("="*80)
-    quant_data = QA(test_tensor, bits_A).data.numpy()
+    quant_data = Q(C(test_tensor, bits_A), bits_A).data.numpy()
     print(quant_data)
     # test QW
     print("="*80)
@@ -139,10 +209,10 @@ if __name__ == "__main__":
     print("="*80)
     quant_data = QW(test_tensor, bits_W, scale=16.0).data.numpy()
     print(quant_data)
-    # test QW
+    # test QE
     print("="*80)
     print("Error")
     print("="*80)
-    quant_data = QE(test_tensor, bits_E).data.numpy()
+    quant_data = QE(test_tensor.clone(), bits_E).data.numpy()
     print(quant_data)
 
@@ -0,0 +1,96 @@
+import zlib
+import torch
+
+__all__ = ['CounterRNG', 'set_sr_rng', 'set_sr_step', 'set_sr_layer']
+
+_rng = None
+_M32 = 0xffffffff
+
+def _mul32(h, c):
+    # (h * c) mod 2**32 for uint32 values in int64, without overflowing int64
+    lo = h * (c & 0xffff)
+    hi = ((h * (c >> 16)) & 0xffff) << 16
+    return (lo + hi) & _M32
+
+def _mix(h):
+    """lowbias32 integer hash, on int64 tensors or python ints holding uint32 values"""
+    h = h ^ (h >> 16)
+    h = _mul32(h, 0x7feb352d)
+    h = h ^ (h >> 15)
+    h = _mul32(h, 0x846ca68b)
+    return h ^ (h >> 16)
+
+class CounterRNG(object):
+    """
+    Counter-based uniforms for stochastic rounding: the number drawn for
+    element i of the gradient of a layer is a hash of (seed, step, sample,
+    layer, i), where sample is the global index of the first sample the
+    gradient was computed from and layer a hash of the layer name (see
+    set_layer). Nothing is carried between calls, so the stream does not
+    depend on the device, the rank, the order of the calls, or what ran
+    before, and a resumed run draws the same numbers. The uniforms are
+    computed `chunk` elements at a time and added in place, never as a
+    full-size tensor. bits_R is the resolution of the uniforms, -1 for the
+    24 bits of fp32.
+    """
+    def __init__(self, seed, bits_R=-1, chunk=2**20):
+        self.seed = seed
+        self.bits = 24 if bits_R == -1 else min(bits_R, 24)
+        self.chunk = chunk
+        self.set_step(0)
+
+    def set_step(self, step, sample=0):
+        self.step = step
+        self.sample = sample
+        self.layer = 0
+
+    def set_layer(self, name):
+        """key the next SR calls by the layer name"""
+        self.layer = zlib.crc32(name.encode())
+
+    def _key(self, *values):
+        k = 0
+        for v in values: k = _mix((k + 0x9e3779b9 + v) & _M32)
+        return k
+
+    def _keys(self):
+        key = self._key(self.seed, self.step, self.sample & _M32, self.sample >> 32, self.layer)
+        return key, self._key(key, 0x85ebca6b)
+
+    def _hash(self, start, n, keys, device):
+        counter = torch.arange(start, start + n, dtype=torch.int64, device=device)
+        return _mix(((_mix(counter ^ keys[0]) + keys[1]) & _M32))
+
+    def sr_(self, x):
+        """x = floor(x + r) in place"""
+        # counters follow the logical (contiguous) order, whatever the layout
+        if not x.is_contiguous(): return x.copy_(self.sr_(x.contiguous()))
+        keys = self._keys()
+        flat = x.view(-1)
+        for start in range(0, flat.numel(), self.chunk):
+            part = flat[start:start+self.chunk]
+            h = self._hash(start, part.numel(), keys, x.device)
+            r = (h >> (32 - self.bits)).to(x.dtype).mul_(2.**-self.bits)
+            part.add_(r).floor_()
+        return x
+
+    def integers(self, shape, device=None):
+        """the same uniforms as int64 in [0, 2**bits), for integer SR"""
+        keys = self._keys()
+        return (self._hash(0, torch.Size(shape).numel(), keys, device) >> (32 - self.bits)).view(shape)
+
+def set_sr_rng(rng):
+    """route the stochastic rounding of QG through rng (None: torch.rand)"""
+    global _rng
+    _rng = rng
+
+def get_sr_rng():
+    return _rng
+
+def set_sr_step(step, sample=0):
+    """sample: global index of the first sample of this rank's batch"""
+    if _rng is not None: _rng.set_step(step, sample)
+
+def set_sr_layer(name):
+    """QG of the layer `name` follows"""
+    if _rng is not None: _rng.set_layer(name)
@@ -0,0 +1,152 @@
+import math
+import torch
+
+__all__ = ['ShiftPredictor', 'set_shift_predictor', 'get_shift_predictor', 'set_shift_step',
+           'shift_limit']
+
+_predictor = None
+
+def _sample(x, stride):
+    """every stride-th element of x (or of each tensor of a list) in memory order, without a copy"""
+    if isinstance(x, (list, tuple)): return [_sample(t, stride) for t in x]
+    if not x.is_contiguous():
+        # e.g. channels_last: the dims sorted by stride are a contiguous view
+        x = x.permute(sorted(range(x.dim()), key=x.stride, reverse=True))
+    return x.reshape(-1)[::stride]
+
+class ShiftPredictor(object):
+    """
+    Predicted shift(max|x|) for QE/QG, instead of a max reduction per tensor.
+    The k-th QE/QG call of a training step keeps an EMA of log2(max|x|) on the
+    device and divides by 2**round(ema + margin). The max is only measured on
+    every `every`-th step (and on the first call). A measured max above the
+    prediction is an overflow: that call falls back to the exact shift and the
+    EMA jumps up to it.
+
+    On the other steps, the max of every `stride`-th element checks for
+    overflow: an overflowing call divides by the shift of that sample
+    instead, and a device-side flag forces a measured step as soon as it
+    reaches the host (after the next step on CUDA, the copy is never waited
+    for). QG also clamps x / shift to the sqrt(2) bound of the exact shift
+    (see shift_limit), so a missed overflow saturates instead of producing
+    oversized updates. summary() is the only sync. state_dict() holds the
+    EMAs and a pending overflow flag, so a resumed run predicts the same
+    shifts; the statistics are not checkpointed.
+    """
+    def __init__(self, momentum=0.9, margin=0., every=4, stride=64):
+        self.momentum = momentum
+        self.margin = margin
+        self.every = every
+        self.stride = stride
+        self.states = {}
+        self.flag = None
+        self.pending = None
+        self.reset_stats()
+        self.set_step(0)
+
+    def set_step(self, step):
+        self.step = step
+        self.calls = 0
+        forced = self._flagged()
+        self.forced += forced
+        self.measure = step % self.every == 0 or forced
+
+    def _flagged(self):
+        """whether an unmeasured step flagged an overflow, without waiting for the device"""
+        flagged = False
+        if self.pending is not None:
+            host, event = self.pending
+            if event is None or event.query():
+                flagged, self.pending = bool(host), None
+        if self.pending is None and self.flag is not None:
+            if self.flag.device.type == 'cuda':
+                host = torch.empty((), dtype=torch.bool, pin_memory=True)
+                host.copy_(self.flag, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                self.pending = (host, event)
+            else:
+                flagged = flagged or bool(self.flag)
+            self.flag = None
+        return flagged
+
+    def state_dict(self):
+        """the per-call EMAs and exponents on the CPU, and whether an overflow is pending"""
+        flagged = False
+        if self.pending is not None:
+            host, event = self.pending
+            if event is not None: event.synchronize()
+            flagged = bool(host)
+        if self.flag is not None: flagged = flagged or bool(self.flag)
+        return {'states': {k: {n: t.cpu() for n, t in state.items()}
+                           for k, state in self.states.items()},
+                'flagged': flagged}
+
+    def load_state_dict(self, state, device='cpu'):
+        self.states = {k: {n: t.to(device) for n, t in s.items()} for k, s in state['states'].items()}
+        self.pending = None
+        # picked up by the next set_step, which then measures
+        self.flag = torch.tensor(state['flagged']) if state['flagged'] else None
+
+    def reset_stats(self):
+        self.measured = self.overflows = self.exp_error = self.forced = 0
+
+    def _log2(self, m):
+        return torch.where(m != 0, torch.log2(m), torch.zeros_like(m))
+
+    def shift(self, x, x_max):
+        """the divisor of QE/QG for x; x_max(t) computes max|t|"""
+        k = self.calls
+        self.calls += 1
+        state = self.states.get(k)
+        if state is not None and not self.measure:
+            m = x_max(_sample(x, self.stride))
+            exact = torch.round(self._log2(m))
+            over = (m != 0) & (exact > state['exp'])
+            self.flag = over.any() if self.flag is None else self.flag | over.any()
+            return 2.**torch.where(over, exact, state['exp'])
+
+        m = x_max(x)
+        seen = m != 0
+        log2 = self._log2(m)
+        if state is None:
+            self.states[k] = {'ema': log2, 'exp': torch.round(log2 + self.margin)}
+            return 2.**torch.round(log2)
+        exact = torch.round(log2)
+        over = seen & (exact > state['exp'])
+        self.measured += m.numel()
+        self.overflows = self.overflows + over.sum()
+        self.exp_error = self.exp_error + torch.where(seen, (exact - state['exp']).abs(), 0*m).sum()
+        exp = torch.where(over, exact, state['exp'])
+        # an all-zero tensor keeps the statistics of the previous ones
+        ema = torch.where(seen, self.momentum * state['ema'] + (1 - self.momentum) * log2, state['ema'])
+        state['ema'] = torch.where(over, torch.maximum(ema, log2), ema)
+        state['exp'] = torch.round(state['ema'] + self.margin)
+        return 2.**exp
+
+    def summary(self):
+        """
+        overflow rate and mean |exponent error| of the measured calls, and the
+        number of steps measured because of a flagged overflow, since reset_stats
+        """
+        n = max(1, self.measured)
+        return {'measured': self.measured, 'overflow': float(self.overflows) / n,
+                'exp-error': float(self.exp_error) / n, 'forced': self.forced}
+
+def set_shift_predictor(predictor):
+    """predict the shift of QE/QG with predictor (None: exact per tensor max)"""
+    global _predictor
+    _predictor = predictor
+
+def get_shift_predictor():
+    return _predictor
+
+def set_shift_step(step):
+    if _predictor is not None: _predictor.set_step(step)
+
+def shift_limit():
+    """
+    bound of |x / shift| in QG. The exact shift rounds log2(max), so it is at
+    most sqrt(2); a predicted shift can be smaller and is clamped to it.
+    """
+    return math.inf if _predictor is None else 2.**0.5
@@ -0,0 +1,67 @@
+import queue
+import threading
+import zlib
+import torch
+
+__all__ = ['Telemetry']
+
+class Telemetry(object):
+    """
+    Sampled quantization statistics. Every `every` steps a `layer_fraction` of
+    the layers record a few scalars, which stay on the device until `flush_every`
+    samples are pending; a background thread then copies them to the host and
+    writes them to the summary writer.
+    """
+    def __init__(self, writer, every=100, layer_fraction=1.0, flush_every=10):
+        self.writer = writer
+        self.every = every
+        self.layer_fraction = layer_fraction
+        self.flush_every = flush_every
+        self.step = 0
+        self.active = False
+        self.samples = 0
+        self.pending = []
+        self.batches = queue.Queue()
+        self.worker = threading.Thread(target=self._write, daemon=True)
+        self.worker.start()
+
+    def set_step(self, step):
+        if self.active:
+            self.samples += 1
+            if self.samples % self.flush_every == 0: self.flush()
+        self.step = step
+        self.active = step % self.every == 0
+
+    def sampled(self, name):
+        if not self.active: return False
+        if self.layer_fraction >= 1: return True
+        # a different subset of layers on every sampled step
+        h = zlib.crc32(("%s-%d" % (name, self.step)).encode()) % 1000
+        return h < self.layer_fraction * 1000
+
+    def record(self, name, stats):
+        tags = ["%s/%s" % (name, k) for k in stats]
+        values = torch.stack([v.detach().float() for v in stats.values()])
+        self.pending.append((self.step, tags, values))
+
+    def flush(self):
+        if len(self.pending) == 0: return
+        steps, tags, values = zip(*self.pending)
+        self.pending = []
+        # one device tensor per flush, copied on the writer thread
+        self.batches.put((steps, tags, torch.cat(values)))
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.worker.join()
+
+    def _write(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None: return
+            steps, tags, values = batch
+            values = iter(values.cpu().tolist())
+            for step, step_tags in zip(steps, tags):
+                for tag in step_tags:
+                    self.writer.add_scalar(tag, next(values), step)
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import collections
+import json
+import queue
+import threading
+import time
+import numpy as np
+import torch
+import export
+import models
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+class Predictor(object):
+    """
+    Frozen WAGE network built once, from a packed ternary export (see
+    --export-packed) or from a train.py checkpoint of any weight width
+    """
+    def __init__(self, net, device='cpu'):
+        self.device = torch.device(device)
+        self.engine = net.to(self.device).eval()
+
+    @classmethod
+    def from_packed(cls, path, device='cpu', sparse=False):
+        return cls(models.TernaryEngine(torch.load(path, map_location='cpu'), sparse=sparse), device)
+
+    @classmethod
+    def from_checkpoint(cls, args, device='cpu'):
+        """args as for export.load_model: --checkpoint, --model and the bit widths"""
+        net, _ = models.inference_net(export.load_model(args))
+        return cls(net, device)
+
+    def predict(self, batch):
+        # batch is [0-1] like the training loader, scale to [-1,1]
+        with torch.no_grad():
+            x = batch.to(self.device, non_blocking=True)*2-1
+            return self.engine(x).cpu()
+
+class LatencyStats(object):
+    """request count and throughput since reset, percentiles of the last `window` requests"""
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = collections.deque(maxlen=self.window)
+            self.requests = 0
+            self.samples = 0
+            self.start = time.perf_counter()
+
+    def add(self, latency, samples):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.samples += samples
+
+    def summary(self):
+        with self.lock:
+            lat = np.array(self.latencies or [0.0]) * 1000.
+            elapsed = time.perf_counter() - self.start
+            return {
+                'requests': self.requests,
+                'p50_ms': float(np.percentile(lat, 50)),
+                'p99_ms': float(np.percentile(lat, 99)),
+                'throughput': self.samples / elapsed,
+            }
+
+class MicroBatcher(object):
+    """
+    Collects requests from any number of threads or coroutines and runs them
+    through the predictor together, up to max_batch samples or max_wait_ms.
+    """
+    def __init__(self, predictor, max_batch=128, max_wait_ms=2.0):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, x):
+        future = Future()
+        self.requests.put((x, future, time.perf_counter()))
+        return future
+
+    def predict(self, x):
+        return self.submit(x).result()
+
+    async def apredict(self, x):
+        return await asyncio.wrap_future(self.submit(x))
+
+    def _loop(self):
+        while True:
+            batch = [self.requests.get()]
+            size = batch[0][0].size(0)
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    req = self.requests.get(timeout=max(0., deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                batch.append(req)
+                size += req[0].size(0)
+            inputs, futures, starts = zip(*batch)
+            try:
+                outputs = self.predictor.predict(torch.cat(inputs)).split(
+                    [x.size(0) for x in inputs])
+            except Exception as e:
+                for future in futures: future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            for x, y, future, start in zip(inputs, outputs, futures, starts):
+                self.stats.add(done - start, x.size(0))
+                future.set_result(y)
+
+IMAGE_SHAPE = (3, 32, 32)
+IMAGE_BYTES = 3 * 32 * 32 * 4
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        # POST /predict with a float32 (N, 3, 32, 32) body, GET /stats
+        def _reply(self, obj, code=200):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_images(self):
+            """the (N, 3, 32, 32) body, or None after replying 400"""
+            try:
+                length = int(self.headers['Content-Length'])
+            except (TypeError, ValueError):
+                self._reply({'error': 'missing or invalid Content-Length'}, 400)
+                return None
+            if length <= 0 or length % IMAGE_BYTES != 0:
+                self._reply({'error': 'body must be float32 (N, 3, 32, 32), got {} bytes'.format(
+                    length)}, 400)
+                return None
+            data = self.rfile.read(length)
+            if len(data) != length:
+                self._reply({'error': 'truncated body'}, 400)
+                return None
+            x = torch.from_numpy(np.frombuffer(data, dtype=np.float32).copy())
+            if not torch.isfinite(x).all():
+                self._reply({'error': 'body has non-finite values'}, 400)
+                return None
+            return x.view(-1, *IMAGE_SHAPE)
+
+        def do_POST(self):
+            if self.path != '/predict': return self._reply({'error': 'not found'}, 404)
+            x = self._read_images()
+            if x is None: return
+            logits = batcher.predict(x)
+            self._reply({'predictions': logits.argmax(1).tolist()})
+
+        def do_GET(self):
+            if self.path != '/stats': return self._reply({'error': 'not found'}, 404)
+            self._reply(batcher.stats.summary())
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def load_test(batcher, requests, concurrency, request_size):
+    x = torch.rand(request_size, 3, 32, 32)
+    batcher.stats.reset()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(lambda _: batcher.predict(x), range(requests)))
+    return batcher.stats.summary()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='WAGE inference server')
+    parser.add_argument('--packed', type=str, default=None, metavar='PATH',
+                        help='packed ternary model exported by train.py --export-packed')
+    parser.add_argument('--checkpoint', type=str, default=None, metavar='PATH',
+                        help='train.py checkpoint, with --model and the bit widths it was trained with')
+    parser.add_argument('--model', type=str, default='VGG7LP', metavar='MODEL')
+    parser.add_argument('--wl-weight', type=int, default=2, metavar='N')
+    parser.add_argument('--wl-activate', type=int, default=8, metavar='N')
+    parser.add_argument('--wl-error', type=int, default=8, metavar='N')
+    parser.add_argument('--bits-config', type=str, default=None, metavar='PATH',
+                        help='per-layer bit widths the checkpoint was trained with')
+    parser.add_argument('--device', type=str, default='cpu', choices=['cpu', 'cuda'])
+    parser.add_argument('--sparse', action='store_true', default=False,
+                        help='run layers with mostly zero weights as sparse adds/subtracts '
+                             '(--packed only)')
+    parser.add_argument('--threads', type=int, default=0, metavar='N',
+                        help='number of intra-op CPU threads; 0 keeps the torch default')
+    parser.add_argument('--max-batch', type=int, default=128, metavar='N')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, metavar='MS')
+    parser.add_argument('--port', type=int, default=8000, metavar='N',
+                        help='serve HTTP on this port')
+    parser.add_argument('--load-test', type=int, default=0, metavar='N',
+                        help='run N local requests instead of serving')
+    parser.add_argument('--concurrency', type=int, default=16, metavar='N')
+    parser.add_argument('--request-size', type=int, default=1, metavar='N')
+    args = parser.parse_args()
+
+    if args.threads > 0: torch.set_num_threads(args.threads)
+    assert (args.packed is None) != (args.checkpoint is None), "give --packed or --checkpoint"
+    if args.packed is not None:
+        predictor = Predictor.from_packed(args.packed, args.device, args.sparse)
+    else:
+        assert not args.sparse, "--sparse needs the packed engine (--packed)"
+        predictor = Predictor.from_checkpoint(args, args.device)
+    batcher = MicroBatcher(predictor, args.max_batch, args.max_wait_ms)
+    if args.load_test > 0:
+        print(json.dumps(load_test(batcher, args.load_test, args.concurrency,
+                                   args.request_size), indent=2))
+    else:
+        print("Serving on port {}".format(args.port))
+        ThreadingHTTPServer(('', args.port), make_handler(batcher)).serve_forever()
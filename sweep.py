@@ -0,0 +1,106 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tabulate
+import data
+
+parser = argparse.ArgumentParser(description='Parallel WAGE seed/bit-width sweep')
+parser.add_argument('--dir', type=str, required=True, help='sweep directory')
+parser.add_argument('--data_path', type=str, default='./data', metavar='PATH')
+parser.add_argument('--shm', type=str, default='/dev/shm/wage-cifar10', metavar='PATH',
+                    help='shared-memory directory for the decoded dataset')
+parser.add_argument('--model', type=str, default='VGG7LP')
+parser.add_argument('--epochs', type=int, default=300, metavar='N')
+parser.add_argument('--seeds', type=int, nargs='+', default=[100, 200, 300, 400])
+parser.add_argument('--wl-weight', type=int, nargs='+', default=[2])
+parser.add_argument('--wl-grad', type=int, nargs='+', default=[8])
+parser.add_argument('--wl-activate', type=int, nargs='+', default=[8])
+parser.add_argument('--wl-error', type=int, nargs='+', default=[8])
+parser.add_argument('--wl-rand', type=int, nargs='+', default=[-1],
+                    help='random number bits of train.py (default: -1, full precision)')
+parser.add_argument('--error-shift', type=str, nargs='+', default=['exact'],
+                    choices=['exact', 'predicted'], help='compare the QE/QG shift modes of train.py')
+parser.add_argument('--jobs', type=int, default=4, metavar='N',
+                    help='number of concurrent runs (default: 4)')
+parser.add_argument('--devices', type=str, nargs='+', default=['cpu'],
+                    help='devices handed out round-robin to the runs, e.g. cuda:0 cuda:1')
+parser.add_argument('extra', nargs=argparse.REMAINDER,
+                    help='arguments passed on to train.py after --')
+
+# resolved next to this file, so the sweep runs from any directory
+TRAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+
+def config_name(cfg):
+    name = "w{}-g{}-a{}-e{}".format(*cfg[:4])
+    if cfg[4] != -1: name += "-r{}".format(cfg[4])
+    return name if cfg[5] == 'exact' else name + '-' + cfg[5]
+
+def run(args, cfg, seed, devices, threads):
+    device = devices.get()
+    try:
+        wl_weight, wl_grad, wl_activate, wl_error, wl_rand, error_shift = cfg
+        run_dir = os.path.join(args.dir, config_name(cfg))
+        cmd = [sys.executable, TRAIN, '--dir', run_dir, '--data_path', args.shm,
+               '--dataset', 'CIFAR10', '--model', args.model, '--epochs', str(args.epochs),
+               '--seed', str(seed), '--fast-data', '--data-mmap',
+               '--wl-weight', str(wl_weight), '--wl-grad', str(wl_grad),
+               '--wl-activate', str(wl_activate), '--wl-error', str(wl_error),
+               '--wl-rand', str(wl_rand), '--error-shift', error_shift,
+               '--device', device.split(':')[0], '--threads', str(threads),
+               '--log-name', '{}-{}-seed-{}'.format(os.path.basename(args.dir),
+                                                      config_name(cfg), seed)]
+        cmd += [a for a in args.extra if a != '--']
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+        if device.startswith('cuda:'): env['CUDA_VISIBLE_DEVICES'] = device.split(':')[1]
+        with open(os.path.join(args.dir, '{}-seed-{}.log'.format(config_name(cfg), seed)), 'w') as log:
+            code = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if code != 0:
+            print("{} seed {} failed with {}".format(config_name(cfg), seed, code))
+            return None
+        with open(os.path.join('{}-seed-{}'.format(run_dir, seed), 'results.json')) as f:
+            return json.load(f)
+    finally:
+        devices.put(device)
+
+def main():
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+    # decode once; every run memory-maps the same page-cache backed arrays
+    data.write_cache(os.path.join(args.data_path, 'cifar10'), os.path.join(args.shm, 'cifar10'))
+
+    configs = list(itertools.product(args.wl_weight, args.wl_grad, args.wl_activate, args.wl_error,
+                                     args.wl_rand, args.error_shift))
+    devices = queue.Queue()
+    for i in range(args.jobs): devices.put(args.devices[i % len(args.devices)])
+    threads = max(1, (os.cpu_count() or 1) // args.jobs)
+
+    with ThreadPoolExecutor(args.jobs) as pool:
+        futures = {(cfg, seed): pool.submit(run, args, cfg, seed, devices, threads)
+                   for cfg in configs for seed in args.seeds}
+        results = {key: f.result() for key, f in futures.items()}
+
+    # results.json holds the last epoch: its time, not the run's
+    columns = ['config', 'runs', 'te_acc_mean', 'te_acc_std', 'tr_acc_mean', 'epoch_time_mean']
+    rows, report = [], {}
+    for cfg in configs:
+        res = [results[(cfg, seed)] for seed in args.seeds if results[(cfg, seed)] is not None]
+        if len(res) == 0: continue
+        te_acc = np.array([r['te_acc'] for r in res])
+        tr_acc = np.array([r['tr_acc'] for r in res])
+        ep_time = np.array([r['time'] for r in res])
+        rows.append([config_name(cfg), len(res), te_acc.mean(), te_acc.std(),
+                     tr_acc.mean(), ep_time.mean()])
+        report[config_name(cfg)] = {'seeds': [s for s in args.seeds if results[(cfg, s)]],
+                                    'runs': res}
+    print(tabulate.tabulate(rows, columns, tablefmt='simple', floatfmt='8.4f'))
+    with open(os.path.join(args.dir, 'sweep.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
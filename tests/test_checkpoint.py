@@ -0,0 +1,84 @@
+import random
+import numpy as np
+import pytest
+import torch
+import models
+import utils
+
+BITS_G = 8
+
+def small_mlp(seed):
+    torch.manual_seed(seed)
+    return models.MLP(wl_activate=8, wl_error=8, wl_weight=2, depth=2, width=32,
+                      in_features=3*8*8)
+
+def batches(n=3, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return [(torch.rand(4, 3, 8, 8, generator=g), torch.randint(0, 10, (4,), generator=g))
+            for _ in range(n)]
+
+def train(model, loader, epoch):
+    utils.train_epoch(loader, model, utils.SSE,
+                      lambda acc, scale, bits: models.QW(acc, bits, scale),
+                      lambda x: models.QG(x, BITS_G, -1, 8.0), None, epoch,
+                      wage_quantize=True, wage_grad_clip=lambda x, bits: models.C(x, bits),
+                      device=torch.device('cpu'))
+
+def draws():
+    return torch.rand(8), np.random.rand(8), random.random()
+
+def save_and_load(state, tmp_path):
+    torch.save(state, tmp_path / 'checkpoint.pt')
+    return torch.load(tmp_path / 'checkpoint.pt', weights_only=False)
+
+@pytest.fixture(params=['exact', 'predicted'])
+def error_shift(request):
+    if request.param == 'predicted': models.set_shift_predictor(models.ShiftPredictor(every=2))
+    yield request.param
+    models.set_shift_predictor(None)
+
+def test_round_trip(tmp_path):
+    model = small_mlp(0)
+    train(model, batches(), 0)
+    state = save_and_load(utils.checkpoint_state(model, 1, BITS_G), tmp_path)
+    ref = draws()
+    # the codes are stored on the 1/S(BITS_G) grid, as int8/int16
+    assert all(entry['bits'] == BITS_G for entry in state['weight_acc'].values())
+
+    resumed = small_mlp(1)
+    assert utils.restore_checkpoint(resumed, state) == 1
+    for name, acc in model.weight_acc.items():
+        assert torch.equal(resumed.weight_acc[name], acc), name
+    assert resumed.weight_scale == model.weight_scale
+    torch_draw, numpy_draw, python_draw = draws()
+    assert torch.equal(torch_draw, ref[0])
+    assert np.array_equal(numpy_draw, ref[1])
+    assert python_draw == ref[2]
+
+def test_resume_matches(tmp_path, error_shift):
+    loader = batches()
+    model = small_mlp(0)
+    train(model, loader, 0)
+    state = save_and_load(utils.checkpoint_state(model, 1, BITS_G), tmp_path)
+    train(model, loader, 1)
+
+    resumed = small_mlp(1)
+    if error_shift == 'predicted': models.set_shift_predictor(models.ShiftPredictor(every=2))
+    utils.restore_checkpoint(resumed, state)
+    train(resumed, loader, 1)
+    for name, acc in model.weight_acc.items():
+        assert torch.equal(resumed.weight_acc[name], acc), name
+
+def test_rank_mismatch():
+    state = utils.checkpoint_state(small_mlp(0), 1, BITS_G, rng=[utils.rng_state()] * 2)
+    with pytest.raises(ValueError):
+        utils.restore_checkpoint(small_mlp(1), state, rank=0, world_size=4)
+
+def test_predictor_needs_state():
+    state = utils.checkpoint_state(small_mlp(0), 1, BITS_G)
+    models.set_shift_predictor(models.ShiftPredictor())
+    try:
+        with pytest.raises(ValueError):
+            utils.restore_checkpoint(small_mlp(1), state)
+    finally:
+        models.set_shift_predictor(None)
@@ -0,0 +1,61 @@
+import pytest
+import torch
+import models
+
+# (bits_W, bits_G): the paper's 2/8, a wide accumulator, and the int32 widening above 15 bits
+BITS = [(2, 8), (1, 8), (4, 12), (8, 15), (2, 16), (16, 16), (8, 24)]
+
+def generator(seed=0):
+    return torch.Generator().manual_seed(seed)
+
+def random_acc(bits_G, shape=(64, 32), seed=0):
+    """accumulators on the 1/S(bits_G) grid, partly beyond C's bounds like after an update"""
+    S = int(models.S(bits_G))
+    return torch.randint(-S - 127, S + 128, shape, generator=generator(seed)).float() / S
+
+def random_grad_codes(shape=(64, 32), seed=1):
+    return torch.randint(-127, 128, shape, generator=generator(seed)).to(torch.int8)
+
+@pytest.mark.parametrize('bits_W, bits_G', BITS)
+def test_widening(bits_W, bits_G):
+    acc = models.IntCodedAcc({'w': random_acc(bits_G)}, bits_W, bits_G)
+    assert acc.codes['w'].dtype == (torch.int16 if bits_G <= 15 else torch.int32)
+    # |acc| = 1 is 2**(bits_G-1), which int16 only holds up to 15 bits
+    acc['w'] = torch.ones(4)
+    assert torch.equal(acc['w'], torch.ones(4))
+
+def test_bits_limits():
+    with pytest.raises(AssertionError):
+        models.IntCodedAcc({}, 8, 4)
+    with pytest.raises(AssertionError):
+        models.IntCodedAcc({}, 8, 25)
+
+@pytest.mark.parametrize('bits_W, bits_G', BITS)
+@pytest.mark.parametrize('scale', [1.0, 4.0])
+def test_accumulate_project(bits_W, bits_G, scale):
+    ref = random_acc(bits_G)
+    acc = models.IntCodedAcc({'w': ref}, bits_W, bits_G)
+    for step in range(3):
+        codes = random_grad_codes(seed=step)
+        ref = models.C(ref, bits_W) - codes.float() / models.S(bits_G)
+        acc.accumulate('w', codes)
+        assert torch.equal(acc['w'], ref)
+        assert torch.equal(acc.project('w', scale), models.QW(ref, bits_W, scale))
+
+@pytest.mark.parametrize('k', [0, 1, 3, 7])
+def test_round_shift(k):
+    x = torch.arange(-1024, 1025, dtype=torch.int32)
+    assert torch.equal(models.round_shift(x, k).float(), torch.round(x.float() / 2**k))
+
+@pytest.mark.parametrize('lr', [1.0, 8.0, 63.0, 64.0, 128.0])
+@pytest.mark.parametrize('bits_G', [8, 16])
+def test_QG_codes(lr, bits_G):
+    x = 0.1 * torch.randn(4096, generator=generator())
+    x[0] = 2.**0.49  # shift 1, so |x / shift| gets close to sqrt(2), the largest code
+    state = torch.get_rng_state()
+    ref = models.QG(x.clone(), bits_G, -1, lr) * models.S(bits_G)
+    torch.set_rng_state(state)
+    codes = models.QG_codes(x.clone(), bits_G, -1, lr)
+    assert codes.dtype == (torch.int8 if lr < 64 else torch.int16)
+    # lr * sqrt(2) passes 127 from lr = 90 on, which int8 codes would wrap
+    assert torch.equal(codes.float(), ref)
@@ -0,0 +1,67 @@
+import shutil
+import pytest
+import torch
+import models
+
+SHAPES = [(128, 3, 3, 3), (1024, 8192), (7,)]
+BITS = [2, 4, 8, 12, 16]
+
+@pytest.fixture(params=['eager', 'compile'])
+def backend(request):
+    if request.param == 'compile' and shutil.which('c++') is None:
+        pytest.skip("torch.compile needs a C++ compiler on CPU")
+    models.set_fused_backend(request.param)
+    yield request.param
+    models.set_fused_backend('eager')
+
+def randn(shape):
+    return torch.randn(*shape, generator=torch.Generator().manual_seed(0))
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('bits', BITS)
+def test_Q(shape, bits):
+    x = randn(shape)
+    assert torch.equal(models.Q_fused(x, bits), models.Q(x, bits))
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('bits', BITS)
+@pytest.mark.parametrize('scale', [1.0, 4.0])
+def test_QW(backend, shape, bits, scale):
+    x = randn(shape)
+    assert torch.equal(models.QW_fused(x, bits, scale), models.QW(x, bits, scale))
+    out = torch.empty_like(x)
+    assert torch.equal(models.QW_fused(x, bits, scale, out=out), models.QW(x, bits, scale))
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('bits', BITS)
+def test_QE(backend, shape, bits):
+    x = randn(shape)
+    assert torch.equal(models.QE_fused(x.clone(), bits), models.QE(x.clone(), bits))
+
+def test_QE_zero(backend):
+    x = torch.zeros(16)
+    assert torch.equal(models.QE_fused(x.clone(), 8), models.QE(x.clone(), 8))
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('bits', BITS)
+@pytest.mark.parametrize('bits_R', [-1, 16])
+def test_QG_torch_rng(backend, shape, bits, bits_R):
+    x = randn(shape)
+    state = torch.get_rng_state()
+    ref = models.QG(x.clone(), bits, bits_R, 8.0)
+    torch.set_rng_state(state)
+    assert torch.equal(models.QG_fused(x.clone(), bits, bits_R, 8.0), ref)
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('bits', BITS)
+@pytest.mark.parametrize('bits_R', [-1, 16])
+def test_QG_counter_rng(backend, shape, bits, bits_R):
+    x = randn(shape)
+    try:
+        models.set_sr_rng(models.CounterRNG(0, bits_R))
+        models.set_sr_step(3)
+        ref = models.QG(x.clone(), bits, bits_R, 8.0)
+        models.set_sr_step(3)
+        assert torch.equal(models.QG_fused(x.clone(), bits, bits_R, 8.0), ref)
+    finally:
+        models.set_sr_rng(None)
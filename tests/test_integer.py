@@ -0,0 +1,86 @@
+import pytest
+import torch
+import models
+import utils
+from models import vgg_low
+
+BITS_W, BITS_G, BITS_R, LR = 2, 8, 8, 8.0
+
+def generator(seed=0):
+    return torch.Generator().manual_seed(seed)
+
+def exact_round_log2(m):
+    k = max(m, 1).bit_length() - 1
+    return k + (m * m >= 2**(2*k + 1))
+
+@pytest.mark.parametrize('m', [0, 1, 2, 3, 5, 6, 181, 182, 2**31 + 1, 3037000499, 3037000500,
+                               2**53 - 1, 2**53 + 1, 2**62 - 1, 2**62, 2**63 - 1])
+def test_round_log2(m):
+    assert int(models.round_log2(torch.tensor(m))) == exact_round_log2(m)
+
+@pytest.mark.parametrize('bits', [2, 4, 8])
+def test_QE_int(bits):
+    x = torch.randint(-2**20, 2**20, (4096,), generator=generator())
+    assert torch.equal(models.QE_int(x, bits).float(), models.QE(x.float(), bits) * models.S(bits))
+    zero = torch.zeros(16, dtype=torch.int64)
+    assert torch.equal(models.QE_int(zero, bits), zero)
+
+@pytest.mark.parametrize('lr_exp', [4, 7])
+def test_QG_int_exact(lr_exp):
+    # max|x| has exponent 4: from lr 2**4 on, the codes are integers and SR leaves them alone
+    x = torch.randint(-16, 17, (4096,), generator=generator())
+    ref = models.QG(x.float(), BITS_G, -1, 2.**lr_exp) * models.S(BITS_G)
+    assert torch.equal(models.QG_int(x, -1, lr_exp).float(), ref)
+
+@pytest.fixture
+def counter():
+    models.set_sr_rng(models.CounterRNG(3, BITS_R))
+    yield
+    models.set_sr_rng(None)
+
+def test_QG_int_counter(counter):
+    x = torch.randint(-2**12, 2**12, (4096,), generator=generator())
+    models.set_sr_step(1, 0)
+    models.set_sr_layer('w')
+    ref = models.QG(x.float(), BITS_G, BITS_R, LR) * models.S(BITS_G)
+    models.set_sr_layer('w')
+    assert torch.equal(models.QG_int(x, BITS_R, 3).float(), ref)
+
+@pytest.fixture
+def small_vgg(monkeypatch):
+    monkeypatch.setitem(vgg_low.cfg, 3, [8, 'M', 16, 'M'])
+    torch.manual_seed(0)
+    model = vgg_low.VGG(wl_activate=8, wl_error=8, wl_weight=BITS_W, depth=3, hidden=32,
+                        image_size=8)
+    model.project_weights(lambda acc, scale, bits: models.QW(acc, bits, scale))
+    return model
+
+def grid_images(n=2):
+    """[0-1] images whose 2x-1 lies on the 8-bit grid, like --data-quantize"""
+    codes = torch.randint(-127, 128, (n, 3, 8, 8), generator=generator())
+    return (codes / 128. + 1) / 2
+
+def test_forward(small_vgg):
+    engine = models.IntegerWAGE(small_vgg, BITS_W, BITS_G, BITS_R)
+    x = grid_images()
+    with torch.no_grad():
+        assert torch.equal(engine.predict(x), small_vgg(x*2-1).double())
+
+def test_step(small_vgg, counter):
+    model, x = small_vgg, grid_images()
+    target = torch.tensor([3, 7])
+    engine = models.IntegerWAGE(model, BITS_W, BITS_G, BITS_R)
+
+    # the fp32 WAGE step of utils.train_epoch; gradients stay below 2**23, so it is exact
+    models.set_sr_step(0, 0)
+    utils.SSE(model(x*2-1), target).backward()
+    acc = {}
+    for name, param in list(model.named_parameters())[::-1]:
+        models.set_sr_layer(name)
+        grad = models.QG(param.grad.data, BITS_G, BITS_R, LR)
+        acc[name] = models.C(model.weight_acc[name], BITS_W) - grad
+
+    models.set_sr_step(0, 0)
+    engine.step(x, target, LR)
+    for name, ref in acc.items():
+        assert torch.equal(engine.acc[name].float() / models.S(BITS_G), ref), name
@@ -0,0 +1,57 @@
+import pytest
+import torch
+import models
+
+@pytest.fixture
+def counter():
+    rng = models.CounterRNG(7, 16)
+    models.set_sr_rng(rng)
+    yield rng
+    models.set_sr_rng(None)
+
+def draw(name, x):
+    models.set_sr_layer(name)
+    return models.SR(x, 16)
+
+def halves(shape=(1000,)):
+    return torch.full(shape, 0.5)
+
+def test_layer_keys(counter):
+    models.set_sr_step(4, 128)
+    a, b = draw('a', halves()), draw('b', halves())
+    assert not torch.equal(a, b)
+    # neither the order of the calls nor calls in between change a layer's numbers
+    models.set_sr_step(4, 128)
+    assert torch.equal(draw('b', halves()), b)
+    draw('c', halves())
+    assert torch.equal(draw('a', halves()), a)
+
+@pytest.mark.parametrize('step, sample', [(5, 128), (4, 129)])
+def test_step_and_sample_keys(counter, step, sample):
+    models.set_sr_step(4, 128)
+    ref = draw('a', halves())
+    models.set_sr_step(step, sample)
+    assert not torch.equal(draw('a', halves()), ref)
+
+def test_resume(counter):
+    models.set_sr_step(10, 640)
+    ref = draw('feature-1-1', halves((64, 3, 3, 3)))
+    # a fresh generator with the same seed, like a resumed run
+    models.set_sr_rng(models.CounterRNG(7, 16))
+    models.set_sr_step(10, 640)
+    assert torch.equal(draw('feature-1-1', halves((64, 3, 3, 3))), ref)
+
+def test_layout_and_chunks(counter):
+    x = torch.rand(4, 8, 3, 3, generator=torch.Generator().manual_seed(0))
+    models.set_sr_step(1)
+    ref = draw('a', x)
+    assert torch.equal(draw('a', x.contiguous(memory_format=torch.channels_last)), ref)
+    counter.chunk = 64
+    assert torch.equal(draw('a', x), ref)
+
+def test_integers_match_uniforms(counter):
+    models.set_sr_step(3, 32)
+    models.set_sr_layer('a')
+    u = counter.integers((1000,))
+    # floor(0.5 + u / 2**16) is 1 exactly when u >= 2**15
+    assert torch.equal(draw('a', halves()), (u >= 2**15).float())
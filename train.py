@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import sys
 import time
@@ -7,6 +8,8 @@ import torch.nn.functional as F
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import utils
+import data
+import distributed
 import tabulate
 import models
 import numpy as np
@@ -24,6 +27,13 @@ parser.add_argument('--batch_size', type=int, default=128, metavar='N',
                     help='input batch size (default: 128)')
 parser.add_argument('--num_workers', type=int, default=4, metavar='N',
                     help='number of workers (default: 4)')
+parser.add_argument('--fast-data', action='store_true', default=False,
+                    help='keep the dataset in one uint8 tensor and augment whole batches')
+parser.add_argument('--data-mmap', action='store_true', default=False,
+                    help='with --fast-data, memory-map the images from a binary cache under '
+                         'data_path, written on first use')
+parser.add_argument('--data-quantize', action='store_true', default=False,
+                    help='with --fast-data, pre-quantize the images to the --wl-activate grid')
 parser.add_argument('--model', type=str, default=None, required=True, metavar='MODEL',
                     help='model name (default: None)')
 parser.add_argument('--epochs', type=int, default=300, metavar='N',
@@ -34,6 +44,16 @@ parser.add_argument('--log-name', type=str, default='', metavar='S',
                     help="Name for the log dir")
 parser.add_argument('--log-error', action='store_true', default=False,
                     help='Whether to log quantization error of weight and grad')
+parser.add_argument('--telemetry-every', type=int, default=0, metavar='N',
+                    help='record quantization statistics every N steps; 0 disables')
+parser.add_argument('--telemetry-layers', type=float, default=1.0, metavar='F',
+                    help='fraction of layers sampled on each telemetry step (default: 1.0)')
+parser.add_argument('--distributed', action='store_true', default=False,
+                    help='data-parallel training over the ranks started by torchrun')
+parser.add_argument('--dist-backend', type=str, default='gloo',
+                    help='torch.distributed backend (default: gloo)')
+parser.add_argument('--profile', action='store_true', default=False,
+                    help='print a per-epoch timing breakdown and write a torch.profiler trace')
 parser.add_argument('--wl-weight', type=int, default=-1, metavar='N',
                     help='word length in bits for weight output; -1 if full precision.')
 parser.add_argument('--fl-weight', type=int, default=-1, metavar='N',
@@ -50,16 +70,93 @@ parser.add_argument('--wl-error', type=int, default=-1, metavar='N',
                     help='word length in bits for backward error; -1 if full precision.')
 parser.add_argument('--fl-error', type=int, default=-1, metavar='N',
                     help='float length in bits for backward error; -1 if full precision.')
+parser.add_argument('--bits-config', type=str, default=None, metavar='PATH',
+                    help='JSON/YAML file with per-layer weight/activate/error bit widths, '
+                         'e.g. from bitsearch.py (default: None)')
 parser.add_argument('--wl-rand', type=int, default=-1, metavar='N',
                     help='word length in bits for rand number; -1 if full precision.')
+parser.add_argument('--sr-rng', type=str, default='torch', choices=['torch', 'counter'],
+                    help='random numbers of the stochastic rounding in QG: the global torch RNG '
+                         '(fp32 uniforms, ignores --wl-rand), or a counter-based hash of (seed, '
+                         'step, sample, layer) at --wl-rand bits that is identical on every device, '
+                         'whatever the call order, and after --resume; ranks train on different '
+                         'samples, so their rounding errors stay uncorrelated (default: torch)')
+parser.add_argument('--error-shift', type=str, default='exact', choices=['exact', 'predicted'],
+                    help='divisor of QE/QG: shift(max|x|) of every tensor, or predicted from an EMA '
+                         'of past maxima with overflow fallback (default: exact)')
+parser.add_argument('--shift-every', type=int, default=4, metavar='N',
+                    help='with --error-shift predicted, measure the maxima every N steps')
+parser.add_argument('--shift-momentum', type=float, default=0.9, metavar='M')
+parser.add_argument('--shift-margin', type=float, default=0., metavar='F',
+                    help='with --error-shift predicted, added to the predicted log2 max')
+parser.add_argument('--device', type=str, default=None, choices=['cpu', 'cuda'],
+                    help='device to train on (default: cuda if available, else cpu)')
+parser.add_argument('--threads', type=int, default=0, metavar='N',
+                    help='number of intra-op CPU threads; 0 keeps the torch default')
+parser.add_argument('--channels-last', action='store_true', default=False,
+                    help='use channels-last memory format for convolutions')
+parser.add_argument('--fused-quant', type=str, default='off', choices=['off', 'eager', 'compile'],
+                    help='use the in-place fused quantizers (default: off)')
+parser.add_argument('--low-memory', action='store_true', default=False,
+                    help='keep the quantized activations saved for backward as int8 codes')
+parser.add_argument('--checkpoint-groups', action='store_true', default=False,
+                    help='recompute each VGG group / ResNet block in backward instead of '
+                         'storing its activations')
+parser.add_argument('--integer', action='store_true', default=False,
+                    help='train with the integer-only engine (models.IntegerWAGE) on CPU; '
+                         'evaluation and checkpoints still go through the fp32 model')
+parser.add_argument('--eval-every', type=int, default=1, metavar='N',
+                    help='evaluate every N epochs, and after the last one (default: 1)')
+parser.add_argument('--eval-early-epochs', type=int, default=0, metavar='N',
+                    help='during the first N epochs, evaluate on a fraction of the test set')
+parser.add_argument('--eval-early-fraction', type=float, default=0.2, metavar='F',
+                    help='fraction of the test set used by --eval-early-epochs (default: 0.2)')
+parser.add_argument('--async-eval', action='store_true', default=False,
+                    help='evaluate a snapshot of the weights on a copy of the model in a '
+                         'background thread while the next epoch trains; on CPU both share '
+                         'the intra-op thread pool, so use --eval-device cuda or a GPU run '
+                         'for real overlap')
+parser.add_argument('--eval-device', type=str, default=None, choices=['cpu', 'cuda'],
+                    help='device of the --async-eval copy (default: --device)')
+parser.add_argument('--flat-acc', action='store_true', default=False,
+                    help='keep accumulators, weights and gradients in flat buffers')
+parser.add_argument('--int-acc', action='store_true', default=False,
+                    help='store accumulators and quantized gradients as integer codes')
+parser.add_argument('--resume', type=str, default=None, metavar='CKPT',
+                    help='checkpoint to resume training from (default: None)')
+parser.add_argument('--save-freq', type=int, default=10, metavar='N',
+                    help='save a checkpoint every N epochs; 0 disables (default: 10)')
+parser.add_argument('--export-packed', action='store_true', default=False,
+                    help='export 2-bit packed weights after training and validate them '
+                         'with the integer inference engine')
+parser.add_argument('--sparse-eval', action='store_true', default=False,
+                    help='evaluate through the packed engine with the mostly zero layers run as '
+                         'sparse adds/subtracts (VGG/MLP, --wl-weight 2); same results as the '
+                         'dense float path')
 
 args = parser.parse_args()
 
+if args.device is None:
+    args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+device = torch.device(args.device)
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+    torch.set_num_interop_threads(1)
+print("Device: {}, threads: {}".format(device, torch.get_num_threads()))
+
+rank, world_size = 0, 1
+if args.distributed:
+    rank, world_size = distributed.init(args.dist_backend)
+    print("Rank {} of {}".format(rank, world_size))
+
 torch.backends.cudnn.enabled = True
 torch.backends.cudnn.benchmark = True
-torch.manual_seed(args.seed)
-torch.cuda.manual_seed(args.seed)
-np.random.seed(args.seed)
+# ranks draw their local SR streams independently; everything that has to
+# agree across ranks (shards, initial weights, averaged updates) is shared
+torch.manual_seed(args.seed + rank)
+torch.cuda.manual_seed(args.seed + rank)
+np.random.seed(args.seed + rank)
 
 
 # Tensorboard Writer
@@ -68,6 +165,7 @@ if args.log_name != "":
 else:
     log_name = "time%d"%int(time.time())
 print("Logging at {}".format(log_name))
+if rank > 0: log_name = "{}-rank{}".format(log_name, rank)
 writer = SummaryWriter(log_dir=os.path.join(".", "runs", log_name))
 
 
@@ -84,8 +182,13 @@ a_summary = quant_summary(args.wl_activate, args.fl_activate)
 e_summary = quant_summary(args.wl_error, args.fl_error)
 print("W:{}, A:{}, G:{}, E:{}".format(w_summary, a_summary, g_summary, e_summary))
 
-weight_quantizer = lambda x, scale: models.QW(x, args.wl_weight, scale)
-grad_clip = lambda x : models.C(x, args.wl_weight)
+QW, QG = models.QW, models.QG
+if args.fused_quant != 'off':
+    models.set_fused_backend(args.fused_quant)
+    QW, QG = models.QW_fused, models.QG_fused
+# bits: the weight width of the layer, args.wl_weight unless --bits-config overrides it
+weight_quantizer = lambda x, scale, bits: QW(x, bits, scale)
+grad_clip = lambda x, bits : models.C(x, bits)
 if args.wl_weight==-1: weight_quantizer = None
 if args.wl_grad ==-1: grad_quantier = None
 
@@ -103,7 +206,19 @@ with open(os.path.join(dir_name, 'command.sh'), 'w') as f:
 assert args.dataset in ["CIFAR10"]
 print('Loading dataset {} from {}'.format(args.dataset, args.data_path))
 
-if args.dataset=="CIFAR10":
+train_sampler = None
+if args.dataset=="CIFAR10" and args.fast_data:
+    path = os.path.join(args.data_path, args.dataset.lower())
+    bits = args.wl_activate if args.data_quantize else -1
+    train_loader = data.TensorLoader(*data.cifar_arrays(path, True, args.data_mmap, bits),
+                                     args.batch_size, device, train=True, rank=rank,
+                                     world_size=world_size,
+                                     seed=args.seed if args.distributed else None, bits=bits)
+    test_loader = data.TensorLoader(*data.cifar_arrays(path, False, args.data_mmap, bits),
+                                    args.batch_size, device, bits=bits)
+    loaders = {'train': train_loader, 'val': train_loader, 'test': test_loader}
+    num_classes = 10
+elif args.dataset=="CIFAR10":
     ds = getattr(datasets, args.dataset)
     path = os.path.join(args.data_path, args.dataset.lower())
     transform_train = transforms.Compose([
@@ -115,45 +230,52 @@ if args.dataset=="CIFAR10":
         transforms.ToTensor(),
     ])
     train_set = ds(path, train=True, download=True, transform=transform_train)
-    val_set = ds(path, train=True, download=True, transform=transform_test)
     test_set = ds(path, train=False, download=True, transform=transform_test)
-    train_sampler = None
+    if args.distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(
+            train_set, world_size, rank, seed=args.seed)
     val_sampler = None
     num_classes = 10
-
-loaders = {
-    'train': torch.utils.data.DataLoader(
-        train_set,
-        batch_size=args.batch_size,
-        shuffle=(train_sampler is None),
-        sampler=train_sampler,
-        num_workers=args.num_workers,
-        pin_memory=True
-    ),
-    'val': torch.utils.data.DataLoader(
-        train_set,
-        batch_size=args.batch_size,
-        sampler=val_sampler,
-        num_workers=args.num_workers,
-        pin_memory=True
-    ),
-    'test': torch.utils.data.DataLoader(
-        test_set,
-        batch_size=args.batch_size,
-        shuffle=False,
-        num_workers=args.num_workers,
-        pin_memory=True
-    )
-}
+    loaders = {
+        'train': torch.utils.data.DataLoader(
+            train_set,
+            batch_size=args.batch_size,
+            shuffle=(train_sampler is None),
+            sampler=train_sampler,
+            num_workers=args.num_workers,
+            pin_memory=(device.type == 'cuda')
+        ),
+        'val': torch.utils.data.DataLoader(
+            train_set,
+            batch_size=args.batch_size,
+            sampler=val_sampler,
+            num_workers=args.num_workers,
+            pin_memory=(device.type == 'cuda')
+        ),
+        'test': torch.utils.data.DataLoader(
+            test_set,
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_workers=args.num_workers,
+            pin_memory=(device.type == 'cuda')
+        )
+    }
 
 # Build model
 print('Model: {}'.format(args.model))
+telemetry = None
+if args.telemetry_every > 0:
+    telemetry = models.Telemetry(writer, args.telemetry_every, args.telemetry_layers)
 model_cfg = getattr(models, args.model)
 model_cfg.kwargs.update({
+    "telemetry":telemetry,
     "wl_activate":args.wl_activate, "fl_activate":args.fl_activate,
     "wl_error":args.wl_error, "fl_error":args.fl_error,
-    "wl_weight":args.wl_weight,
+    "wl_weight":args.wl_weight, "fused":args.fused_quant != 'off',
 })
+if args.bits_config is not None:
+    model_cfg.kwargs["bits"] = models.load_bits(args.bits_config)
+    print("Per-layer bits: {}".format(model_cfg.kwargs["bits"]))
 
 if args.log_error:
     model = model_cfg.base(
@@ -165,11 +287,44 @@ else:
             *model_cfg.args,
             num_classes=num_classes, writer=None,
             **model_cfg.kwargs)
-model.cuda()
-for name, param_acc in model.weight_acc.items():
-    model.weight_acc[name] = param_acc.cuda()
+model.set_low_memory(args.low_memory, args.checkpoint_groups)
+# weight_acc follows the model through WAGENet._apply
+model.to(device=device, memory_format=memory_format)
+if args.flat_acc or args.int_acc or args.export_packed or args.integer or args.sparse_eval:
+    assert set(model.wl_weight.values()) == {args.wl_weight}, \
+        "--flat-acc, --int-acc, --export-packed and --sparse-eval need the same weight bits in every layer"
+if args.sparse_eval:
+    assert args.wl_weight == 2, "--sparse-eval runs ternary weights"
+    assert hasattr(model, 'features') and hasattr(model, 'classifier'), "--sparse-eval packs VGG/MLP models"
+    assert not args.async_eval, "--sparse-eval evaluates the packed engine in the training loop"
+wage_flat = None
+if args.flat_acc:
+    # must come after model.to(), which would replace the views
+    wage_flat = models.FlatWAGE(model, args.wl_weight, args.wl_grad, args.wl_rand)
+if args.int_acc:
+    assert not args.flat_acc, "--int-acc and --flat-acc are exclusive"
+    model.weight_acc = models.IntCodedAcc(model.weight_acc, args.wl_weight, args.wl_grad)
 
 criterion = utils.SSE
+integer_engine = None
+if args.integer:
+    assert not (args.flat_acc or args.int_acc or args.distributed), \
+        "--integer keeps its own accumulators"
+    assert 1 < args.wl_activate <= 8, "--integer needs int8 activation codes (--wl-activate 2..8)"
+    # the engine quantizes the images to the --wl-activate grid; the fp32 model
+    # (evaluation, checkpoints) only sees the same inputs if the loader does too
+    assert args.fast_data and args.data_quantize, "--integer needs --fast-data --data-quantize"
+    integer_engine = models.IntegerWAGE(model, args.wl_weight, args.wl_grad, args.wl_rand,
+                                        args.wl_activate)
+if args.sr_rng == 'counter':
+    # keyed by the global sample index, not the rank: ranks still draw different
+    # numbers, so averaging their codes cancels the rounding errors
+    models.set_sr_rng(models.CounterRNG(args.seed, args.wl_rand))
+shift_predictor = None
+if args.error_shift == 'predicted':
+    assert not args.integer, "--integer computes its shifts with integer max reductions"
+    shift_predictor = models.ShiftPredictor(args.shift_momentum, args.shift_margin, args.shift_every)
+    models.set_shift_predictor(shift_predictor)
 
 def schedule(epoch):
     if epoch < 200:
@@ -179,35 +334,109 @@ def schedule(epoch):
     else:
         return 1/8.
 
+if args.distributed:
+    assert not args.flat_acc, "--distributed exchanges per-layer gradient codes"
+    distributed.broadcast_state(model)
+    grad_exchange = distributed.QuantizedGradExchange(args.seed, device)
+
 start_epoch = 0
+checkpointer = utils.AsyncCheckpointer(dir_name)
+if args.resume is not None:
+    print('Resuming from {}'.format(args.resume))
+    state = torch.load(args.resume, map_location='cpu', weights_only=False)
+    # every rank resumes its own RNG streams (seeded with seed + rank)
+    start_epoch = utils.restore_checkpoint(model, state, rank, world_size)
+    if args.distributed: grad_exchange.load_state_dict(state['exchange'])
+    if integer_engine is not None: integer_engine.load(model)
 
 # Prepare logging
 columns = ['ep', 'lr', 'tr_loss', 'tr_acc', 'tr_acc2',
            'te_loss', 'te_acc', 'te_acc2', 'time']
 
+profiler = None
+if args.profile:
+    profiler = models.Profiler(sync=device.type == 'cuda')
+    models.set_profiler(profiler)
+    profiler.start_trace(os.path.join(dir_name, 'trace.json'))
+profile_columns = ['region', 'total_s', 'ms_call', 'perc_ep']
+
 def log_result(writer, name, res, step):
     writer.add_scalar("{}/loss".format(name),     res['loss'],            step)
     writer.add_scalar("{}/acc_perc".format(name), res['accuracy'],        step)
     writer.add_scalar("{}/err_perc".format(name), 100. - res['accuracy'], step)
 
+# the latest finished evaluation, printed with the epoch that follows it
+test_res = {'loss': float('nan'), 'accuracy': float('nan'), 'semi_accuracy': float('nan')}
+def test_done(epoch, res):
+    global test_res
+    test_res = res
+    log_result(writer, "test", res, epoch+1)
+
+evaluator = None
+if args.async_eval:
+    eval_device = torch.device(args.eval_device) if args.eval_device is not None else device
+    # a plain copy: no writer or telemetry, and param.data is set from snapshots
+    # fork the RNG: wage_init_ of the copy must not consume the (seeded or resumed)
+    # training stream, or --async-eval would change the run
+    with torch.random.fork_rng(devices=[]):
+        eval_model = model_cfg.base(*model_cfg.args, num_classes=num_classes, writer=None,
+                                    **dict(model_cfg.kwargs, telemetry=None))
+    eval_model.to(device=eval_device, memory_format=memory_format)
+    evaluator = utils.AsyncEvaluator(eval_model, criterion, test_done, eval_device, memory_format)
+
 for epoch in range(start_epoch, args.epochs):
     time_ep = time.time()
     lr = schedule(epoch)
     writer.add_scalar("lr", lr, epoch)
-    grad_quantizer = lambda x : models.QG(x, args.wl_grad, args.wl_rand, lr)
-
-    train_res = utils.train_epoch(
-            loaders['train'], model, criterion,
-            weight_quantizer, grad_quantizer, writer, epoch,
-            log_error=args.log_error,
-            wage_quantize=True,
-            wage_grad_clip=grad_clip
-    )
+    grad_quantizer = lambda x : QG(x, args.wl_grad, args.wl_rand, lr)
+    if args.int_acc:
+        grad_quantizer = lambda x : models.QG_codes(x, args.wl_grad, args.wl_rand, lr)
+    if args.distributed:
+        # only a common shift and the int8 gradient codes are exchanged
+        exchange = lambda x : grad_exchange(x, args.wl_grad, args.wl_rand, lr)
+        grad_quantizer = exchange if args.int_acc else \
+            (lambda x : exchange(x) / models.S(args.wl_grad))
+        if train_sampler is not None: train_sampler.set_epoch(epoch)
+        else: loaders['train'].set_epoch(epoch)
+    if wage_flat is not None: wage_flat.lr = lr
+
+    if integer_engine is not None:
+        train_res = utils.train_epoch_integer(loaders['train'], integer_engine, epoch, lr,
+                                              telemetry=telemetry)
+        # evaluate and checkpoint the integer accumulators through the fp32 model
+        integer_engine.store(model)
+    else:
+        train_res = utils.train_epoch(
+                loaders['train'], model, criterion,
+                weight_quantizer, grad_quantizer, writer, epoch,
+                log_error=args.log_error,
+                wage_quantize=True,
+                wage_grad_clip=grad_clip,
+                device=device,
+                memory_format=memory_format,
+                wage_flat=wage_flat,
+                telemetry=telemetry,
+                rank=rank,
+                world_size=world_size
+        )
     log_result(writer, "train", train_res, epoch+1)
 
     # Validation
-    test_res = utils.eval(loaders['test'], model, criterion, weight_quantizer)
-    log_result(writer, "test", test_res, epoch+1)
+    if (epoch + 1) % args.eval_every == 0 or epoch + 1 == args.epochs:
+        test_loader = loaders['test']
+        if epoch < args.eval_early_epochs:
+            test_loader = utils.FirstBatches(test_loader, args.eval_early_fraction)
+        with models.profile_region('eval'):
+            if evaluator is not None:
+                model.project_weights(weight_quantizer)
+                evaluator.submit(model, test_loader, epoch)
+            elif args.sparse_eval:
+                # the current weights, packed; the engine computes the same exact sums
+                engine = models.TernaryEngine(models.export_packed(model, args.wl_weight), sparse=True)
+                test_done(epoch, utils.eval(test_loader, engine.to(device), criterion, device=device))
+            else:
+                test_done(epoch, utils.eval(test_loader, model, criterion, weight_quantizer,
+                                            device=device, memory_format=memory_format))
 
     time_ep = time.time() - time_ep
     values = [epoch + 1, lr, train_res['loss'], train_res['accuracy'],
@@ -220,6 +449,43 @@ for epoch in range(start_epoch, args.epochs):
         table = '\n'.join([table[1]] + table)
     else:
         table = table.split('\n')[2]
-    print(table)
+    if rank == 0: print(table)
+    if shift_predictor is not None:
+        if rank == 0: print("predicted shifts: {}".format(shift_predictor.summary()))
+        shift_predictor.reset_stats()
+    if profiler is not None:
+        if rank == 0:
+            print(tabulate.tabulate(profiler.rows(time_ep), profile_columns,
+                                    tablefmt='simple', floatfmt='8.4f'))
+        profiler.reset()
+
+    if args.save_freq > 0 and ((epoch + 1) % args.save_freq == 0 or epoch + 1 == args.epochs):
+        # the RNG states of all ranks go into rank 0's checkpoint
+        rng = distributed.gather_rng(utils.rng_state()) if args.distributed else None
+        if rank == 0:
+            # accumulators sit on the 1/S(wl_grad) grid
+            state = utils.checkpoint_state(model, epoch + 1, args.wl_grad, rng)
+            if args.distributed: state['exchange'] = grad_exchange.state_dict()
+            checkpointer.save(state, 'checkpoint-%d.pt' % (epoch + 1))
+
+# final row, e.g. for sweep.py
+if evaluator is not None:
+    evaluator.wait()
+    values[5:8] = [test_res['loss'], test_res['accuracy'], test_res['semi_accuracy']]
+if rank == 0:
+    with open(os.path.join(dir_name, 'results.json'), 'w') as f:
+        json.dump(dict(zip(columns, values)), f)
 
+checkpointer.wait()
+if profiler is not None: profiler.stop_trace()
+if telemetry is not None: telemetry.close()
 
+if args.export_packed:
+    packed = models.export_packed(model, args.wl_weight)
+    torch.save(packed, os.path.join(dir_name, 'wage_packed.pt'))
+    engine = models.TernaryEngine(packed, sparse=args.sparse_eval).to(device)
+    engine_res = utils.eval(loaders['test'], engine, criterion, device=device)
+    print("packed engine: te_acc {:.4f} (float path {:.4f})".format(
+        engine_res['accuracy'], test_res['accuracy']))
+    print(tabulate.tabulate(engine.sparsity_rows(), ['layer', 'shape', 'zeros', 'mode'],
+                            tablefmt='simple', floatfmt='6.4f'))
@@ -1,36 +1,79 @@
+import itertools
+import math
 import os
+import random
+import threading
+import numpy as np
 import torch
 import models
 
 def SSE(logits, label):
-    target = torch.zeros_like(logits)
-    target[torch.arange(target.size(0)).long(), label] = 1
-    out =  0.5*((logits-target)**2).sum()
-    return out
+    return SSE_metrics(logits, label)[0]
+
+def SSE_metrics(logits, label):
+    """
+    0.5*||logits - onehot(label)||^2 without building the one-hot target,
+    plus the top-1 and in_top_k (ties count, like tensorflow) counts from
+    the same gathered label logits and a single max pass. The difference is
+    formed before squaring: expanding the square cancels in fp32 once the
+    loss is small next to ||logits||^2.
+    """
+    label_logit = logits.gather(1, label.view(-1, 1)).view(-1)
+    diff = logits.scatter_add(1, label.view(-1, 1), -torch.ones_like(label_logit).view(-1, 1))
+    loss = 0.5*(diff*diff).sum()
+    correct, semi_correct = top1_metrics(logits.detach(), label, label_logit.detach())
+    return loss, correct, semi_correct
+
+def top1_metrics(logits, label, label_logit=None):
+    if label_logit is None: label_logit = logits.gather(1, label.view(-1, 1)).view(-1)
+    max_logit, pred = logits.max(1)
+    return (pred == label).sum(), (label_logit == max_logit).sum()
+
+def loss_metrics(criterion, output, target):
+    """loss, top-1 count and in_top_k count, all left on the device"""
+    if criterion is SSE: return SSE_metrics(output, target)
+    return (criterion(output, target),) + top1_metrics(output.detach(), target)
+
+def to_device(input_v, target, device, memory_format=torch.contiguous_format):
+    input_v = input_v.to(device, non_blocking=True)
+    input_v = input_v.contiguous(memory_format=memory_format)
+    target = target.to(device, non_blocking=True)
+    return input_v, target
 
 def train_epoch(loader, model, criterion, weight_quantizer, grad_quantizer,
                 writer, epoch, quant_bias=True, quant_bn=True, log_error=False,
-                wage_quantize=False, wage_grad_clip=None):
-    loss_sum = 0.0
-    correct = 0.0
-    semi_correct = 0.0
+                wage_quantize=False, wage_grad_clip=None, device=None,
+                memory_format=torch.contiguous_format, wage_flat=None, telemetry=None,
+                rank=0, world_size=1):
+    if device is None: device = next(model.parameters()).device
+    # accumulate on device, synchronize only once at the end of the epoch
+    loss_sum = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    semi_correct = torch.zeros((), dtype=torch.long, device=device)
 
     model.train()
     ttl = 0
 
-    for i, (input_v, target) in enumerate(loader):
+    region = models.profile_region
+    # only stale layers (resume, broadcast); afterwards every update projects its own layer
+    with region('QW'):
+        model.project_weights(weight_quantizer)
+    int_acc = isinstance(model.weight_acc, models.IntCodedAcc)
+    for i, (input_v, target) in enumerate(models.profile_iter(loader)):
         step = i+epoch*len(loader)
-        input_v = input_v.cuda(async=True)
+        if telemetry is not None: telemetry.set_step(step)
+        # shards are strided (see data.TensorLoader): the rank's first sample of the step
+        models.set_sr_step(step, step * input_v.size(0) * world_size + rank)
+        models.set_shift_step(step)
+        input_v, target = to_device(input_v, target, device, memory_format)
         # input is [0-1], scale to [-1,1]
         input_v = input_v*2-1
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input_v)
-        target_var = torch.autograd.Variable(target)
+        input_var = input_v
+        target_var = target
 
-        # WAGE quantize 8-bits accumulation into ternary before forward
+        # param.data already holds the ternary projection of the 8-bit
+        # accumulators: it is computed right after each update below
         # assume no batch norm
-        for name, param in model.named_parameters():
-            param.data = weight_quantizer(model.weight_acc[name], model.weight_scale[name])
 
         # Write ternary parameters
         if log_error:
@@ -40,15 +83,21 @@ def train_epoch(loader, model, criterion, weight_quantizer, grad_quantizer,
                 writer.add_histogram(
                     "param-quant/%s"%name, param.clone().cpu().data.numpy(), step)
 
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        with region('forward'):
+            output = model(input_var)
+            loss, batch_correct, batch_semi = loss_metrics(criterion, output, target_var)
 
         if log_error:
             writer.add_scalar( "batch-train-loss", loss.item(), step)
             writer.add_histogram("output", output.cpu().data.numpy(), step)
 
-        model.zero_grad()
-        loss.backward()
+        if wage_flat is not None:
+            wage_flat.zero_grad()
+        else:
+            model.zero_grad()
+        # includes the QE calls of WAGERounding.backward
+        with region('backward'):
+            loss.backward()
 
         # Write high precision gradient
         if log_error:
@@ -56,33 +105,64 @@ def train_epoch(loader, model, criterion, weight_quantizer, grad_quantizer,
                 writer.add_histogram(
                     "gradient-before/%s"%name, param.grad.clone().cpu().data.numpy(), step)
 
+        # Sampled on-device statistics, see models.Telemetry
+        if telemetry is not None:
+            for name, param in model.named_parameters():
+                if telemetry.sampled(name):
+                    telemetry.record("gradient/%s" % name, {
+                        'shift': models.shift_exponent(param.grad),
+                        'weight-zero-frac': (param.data == 0).float().mean()})
+
         # gradient quantization
-        for name, param in list(model.named_parameters())[::-1]:
-            param.grad.data = grad_quantizer(param.grad.data).data
+        if wage_flat is not None:
+            with region('QG+update'):
+                wage_flat.step()
+            with region('QW'):
+                wage_flat.project()
+        elif int_acc:
+            # grad_quantizer returns integer codes here, see models.QG_codes
+            for name, param in list(model.named_parameters())[::-1]:
+                if param.grad is None: continue # frozen
+                models.set_sr_layer(name)
+                with region('QG'):
+                    grad_codes = grad_quantizer(param.grad.data)
+                if log_error:
+                    # for the gradient-after histogram: the quantized gradient, not the raw one
+                    param.grad.data = grad_codes.float() / models.S(model.weight_acc.bits_G)
+                with region('update'):
+                    model.weight_acc.accumulate(name, grad_codes)
+                    model.mark_updated(name)
+                with region('QW'):
+                    model.project_layer(name, param, weight_quantizer)
+        else:
+            for name, param in list(model.named_parameters())[::-1]:
+                if param.grad is None: continue # frozen
+                models.set_sr_layer(name)
+                with region('QG'):
+                    param.grad.data = grad_quantizer(param.grad.data).data
+
+                # WAGE accumulate weight in gradient precision
+                # assume no batch norm
+                with region('update'):
+                    w_acc =  wage_grad_clip(model.weight_acc[name], model.wl_weight[name])
+                    w_acc -= param.grad.data
+                    model.weight_acc[name] = w_acc
+                    model.mark_updated(name)
+                with region('QW'):
+                    model.project_layer(name, param, weight_quantizer)
 
-            # Write 8-bits gradients
-            if log_error:
+        # Write 8-bits gradients
+        if log_error:
+            for name, param in model.named_parameters():
                 writer.add_histogram(
                     "gradient-after/%s"%name, param.grad.clone().cpu().data.numpy(), step)
 
-            # WAGE accumulate weight in gradient precision
-            # assume no batch norm
-            w_acc =  wage_grad_clip(model.weight_acc[name])
-            w_acc -= param.grad.data
-            model.weight_acc[name] = w_acc
-
-        loss_sum += loss.cpu().item() * input_v.size(0)
-        pred = output.data.max(1, keepdim=True)[1]
-        correct += pred.eq(target_var.data.view_as(pred)).sum()
+        loss_sum += loss.detach() * input_v.size(0)
+        correct += batch_correct
+        semi_correct += batch_semi
         ttl += input_v.size()[0]
 
-        # Compute in_top_k, similar to tensorflow
-        max_output = output.max(1, keepdim=True)
-        semi_correct += torch.eq(
-            output[torch.arange(pred.size(0)), target],
-            output.max(1)[0]
-        ).sum()
-
+    loss_sum = loss_sum.cpu().item()
     semi_correct = semi_correct.cpu().item()
     correct = correct.cpu().item()
     return {
@@ -92,40 +172,59 @@ def train_epoch(loader, model, criterion, weight_quantizer, grad_quantizer,
     }
 
 
-def eval(loader, model, criterion, wage_quantizer=None):
-    loss_sum = 0.0
-    correct = 0.0
-    semi_correct = 0.0
+def train_epoch_integer(loader, engine, epoch, lr, telemetry=None):
+    """train_epoch for models.IntegerWAGE, on CPU"""
+    loss_sum = torch.zeros((), dtype=torch.float64)
+    correct = torch.zeros((), dtype=torch.long)
+    semi_correct = torch.zeros((), dtype=torch.long)
+    ttl = 0
+    region = models.profile_region
+    for i, (input_v, target) in enumerate(models.profile_iter(loader)):
+        step = i+epoch*len(loader)
+        if telemetry is not None: telemetry.set_step(step)
+        models.set_sr_step(step, step * input_v.size(0))
+        with region('integer-step'):
+            loss, batch_correct, batch_semi = engine.step(input_v.cpu(), target.cpu(), lr)
+        loss_sum += loss
+        correct += batch_correct
+        semi_correct += batch_semi
+        ttl += input_v.size(0)
+    return {
+        'loss': loss_sum.item() / float(ttl),
+        'accuracy': correct.item() / float(ttl) * 100.0,
+        'semi_accuracy': semi_correct.item() / float(ttl) * 100.0,
+    }
+
+
+def eval(loader, model, criterion, wage_quantizer=None, device=None,
+         memory_format=torch.contiguous_format):
+    if device is None: device = next(model.parameters()).device
+    loss_sum = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    semi_correct = torch.zeros((), dtype=torch.long, device=device)
 
     model.eval()
     cnt = 0
 
-    # WAGE quantize 8-bits accumulation into ternary before forward
-    # assume no batch norm
-    for name, param in model.named_parameters():
-        param.data = wage_quantizer(model.weight_acc[name], model.weight_scale[name])
+    # WAGE quantize 8-bits accumulation into ternary before forward, reusing
+    # the projection of the last training step when nothing changed since
+    if wage_quantizer is not None:
+        model.project_weights(wage_quantizer)
 
     with torch.no_grad():
         for i, (input_v, target) in enumerate(loader):
-            input_v = input_v.cuda(async=True)
+            input_v, target = to_device(input_v, target, device, memory_format)
             input_v = input_v*2-1
-            target = target.cuda(async=True)
 
             output = model(input_v)
-            loss = criterion(output, target)
+            loss, batch_correct, batch_semi = loss_metrics(criterion, output, target)
 
-            loss_sum += loss.data.cpu().item() * input_v.size(0)
-            pred = output.data.max(1, keepdim=True)[1]
-            correct += pred.eq(target.data.view_as(pred)).sum()
+            loss_sum += loss * input_v.size(0)
+            correct += batch_correct
+            semi_correct += batch_semi
             cnt += int(input_v.size()[0])
 
-            # Compute in_top_k, similar to tensorflow
-            max_output = output.max(1, keepdim=True)
-            semi_correct += torch.eq(
-                output[torch.arange(pred.size(0)), target],
-                output.max(1)[0]
-            ).sum()
-
+    loss_sum = loss_sum.cpu().item()
     correct = correct.cpu().item()
     semi_correct = semi_correct.cpu().item()
 
@@ -135,3 +234,162 @@ def eval(loader, model, criterion, wage_quantizer=None):
         'semi_accuracy': semi_correct / float(cnt) * 100.0,
     }
 
+
+def encode_acc(acc, bits):
+    """weight_acc lives on the 1/S(bits) grid: store it as int8/int16 codes"""
+    if bits != -1:
+        codes = acc * models.S(bits)
+        if torch.equal(codes, codes.round()):
+            dtype = torch.int8 if codes.abs().max() <= 127 else torch.int16
+            if codes.abs().max() <= torch.iinfo(dtype).max:
+                return {'codes': codes.to(dtype), 'bits': bits}
+    return {'codes': acc.clone(), 'bits': -1}
+
+def decode_acc(entry):
+    if entry['bits'] == -1: return entry['codes'].float()
+    return entry['codes'].float() / models.S(entry['bits'])
+
+def rng_state():
+    """
+    the RNG states of this process, and the state of the ShiftPredictor if
+    one is set, which like them differs between ranks
+    """
+    state = {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+        'python': random.getstate(),
+    }
+    predictor = models.get_shift_predictor()
+    if predictor is not None: state['shift'] = predictor.state_dict()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if len(state['cuda']) > 0: torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+def checkpoint_state(model, epoch, acc_bits, rng=None):
+    """
+    everything needed to resume training bit-exactly after `epoch`. rng: the
+    rng_state() of every rank for distributed runs, indexed by rank
+    """
+    return {
+        'epoch': epoch,
+        'weight_acc': {name: encode_acc(acc.detach().cpu(), acc_bits)
+                       for name, acc in model.weight_acc.items()},
+        'weight_scale': dict(model.weight_scale),
+        'rng': rng_state() if rng is None else rng,
+    }
+
+def load_weights(model, state):
+    """the accumulators and scales of a checkpoint, without its RNG state"""
+    for name, entry in state['weight_acc'].items():
+        # copy, so that accumulators backed by a flat buffer stay views, and
+        # assign, so that IntCodedAcc re-encodes the decoded copy
+        model.weight_acc[name] = model.weight_acc[name].copy_(decode_acc(entry))
+    model.weight_scale.update(state['weight_scale'])
+    model.invalidate_weights()
+
+def restore_checkpoint(model, state, rank=0, world_size=1):
+    load_weights(model, state)
+    rng = state['rng']
+    if isinstance(rng, list):
+        if len(rng) != world_size:
+            raise ValueError("checkpoint of {} ranks, resuming with {}".format(len(rng), world_size))
+        rng = rng[rank]
+    elif world_size > 1:
+        raise ValueError("checkpoint of a single process, resuming with {} ranks".format(world_size))
+    set_rng_state(rng)
+    predictor = models.get_shift_predictor()
+    if predictor is not None:
+        # a predictor warming up again would pick other shifts than the original run
+        if 'shift' not in rng:
+            raise ValueError("checkpoint without predicted shifts, resume with --error-shift exact")
+        predictor.load_state_dict(rng['shift'], next(model.parameters()).device)
+    return state['epoch']
+
+class FirstBatches(object):
+    """the first `fraction` of the batches of an (unshuffled) loader"""
+    def __init__(self, loader, fraction):
+        self.loader = loader
+        self.n = max(1, int(math.ceil(len(loader) * fraction)))
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        it = iter(self.loader)
+        try:
+            for batch in itertools.islice(it, self.n): yield batch
+        finally:
+            if hasattr(it, 'close'): it.close()
+
+class AsyncEvaluator(object):
+    """
+    Evaluates snapshots of the projected weights on a separate copy of the
+    model in a background thread, on its own CUDA stream, while the next
+    epoch trains. One evaluation at a time: submit() waits for the previous
+    one. callback(epoch, result) runs in the background thread. On CPU both
+    threads share the intra-op thread pool, so there is little overlap.
+    """
+    def __init__(self, eval_model, criterion, callback, device, memory_format=torch.contiguous_format):
+        self.model = eval_model
+        self.criterion = criterion
+        self.callback = callback
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.thread = None
+        self.error = None
+
+    def submit(self, model, loader, epoch):
+        """snapshot param.data of model, which must already hold the projected weights"""
+        self.wait()
+        with torch.no_grad():
+            for p_eval, p in zip(self.model.parameters(), model.parameters()):
+                p_eval.data.copy_(p.data)
+        if self.stream is not None: self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        def run():
+            try:
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        res = eval(loader, self.model, self.criterion, device=self.device,
+                                   memory_format=self.memory_format)
+                else:
+                    res = eval(loader, self.model, self.criterion, device=self.device,
+                               memory_format=self.memory_format)
+                self.callback(epoch, res)
+            except Exception as e:
+                self.error = e
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints from a background thread, one at a time"""
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+        self.thread = None
+
+    def save(self, state, name):
+        self.wait()
+        path = os.path.join(self.dir_name, name)
+        def write():
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        self.thread = threading.Thread(target=write)
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None